@@ -0,0 +1,192 @@
+"""
+Cache for RunKeeper fitness activity data, stored in Redis.
+
+Activity documents hardly ever change once recorded, so syncs keep the data
+they extracted from each of them, keyed by activity URI. Entries are tied to
+a fingerprint of the activity's feed item: if RunKeeper reports different
+metadata for the activity (e.g. because it was edited), the entry is ignored
+and the activity is fetched again.
+
+Entries are stored zlib-compressed, as GPS paths make them large. The total
+size of the entries is bounded; when it's exceeded the least recently used
+entries are evicted.
+
+The cache is optional: if Redis fails, entries are missing and aren't stored.
+"""
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+from redis import RedisError, StrictRedis
+
+logger = logging.getLogger(__name__)
+
+# Store an entry, updating the index and the total size.
+#
+# KEYS: the entry, the index, the sizes hash and the total size
+# ARGV: the uri, the entry, the time it's used and its expiry (in seconds,
+#       "" for none)
+# Returns the new total size.
+SET_SCRIPT = """
+local size = string.len(ARGV[2])
+local previous = tonumber(redis.call("HGET", KEYS[3], ARGV[1])) or 0
+if ARGV[4] ~= "" then
+    redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[4])
+else
+    redis.call("SET", KEYS[1], ARGV[2])
+end
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[1])
+redis.call("HSET", KEYS[3], ARGV[1], size)
+return redis.call("INCRBY", KEYS[4], size - previous)
+"""
+
+# Remove entries, updating the index and the total size. Sizes are only
+# subtracted by whoever removes an entry first, so concurrent evictions keep
+# the total right.
+#
+# KEYS: the index, the sizes hash and the total size, then the key of each
+#       entry
+# ARGV: the uri of each entry
+# Returns the new total size.
+REMOVE_SCRIPT = """
+local freed = 0
+for i, uri in ipairs(ARGV) do
+    local size = redis.call("HGET", KEYS[2], uri)
+    if size then
+        freed = freed + tonumber(size)
+        redis.call("HDEL", KEYS[2], uri)
+    end
+    redis.call("ZREM", KEYS[1], uri)
+    redis.call("DEL", KEYS[i + 3])
+end
+return redis.call("DECRBY", KEYS[3], freed)
+"""
+
+
+class ActivityCache:
+
+    redis_prefix = 'RunkeeperActivityCache'
+
+    # Least recently used entries looked at per round of eviction.
+    eviction_batch = 100
+
+    def __init__(self, redis, max_bytes, timeout=None):
+        self.redis = redis
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._set_script = redis.register_script(SET_SCRIPT)
+        self._remove_script = redis.register_script(REMOVE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(StrictRedis.from_url(url), **kwargs)
+
+    @staticmethod
+    def fingerprint(feed_item):
+        """
+        Return a fingerprint of the metadata RunKeeper lists for an activity.
+        """
+        serialized = json.dumps(feed_item, sort_keys=True)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def get(self, uri, fingerprint):
+        """
+        Return cached data for uri, or None if missing or outdated.
+        """
+        pipe = self.redis.pipeline()
+        pipe.get(self._entry_key(uri))
+        # Mark as recently used, only if the entry is still indexed.
+        pipe.execute_command('ZADD', self._index_key, 'XX', time.time(), uri)
+        try:
+            raw_entry = pipe.execute()[0]
+        except RedisError as e:
+            logger.warning('Activity cache unavailable: {!r}'.format(e))
+            return None
+        if raw_entry is None:
+            return None
+        try:
+            entry = self._decode(raw_entry)
+        except (zlib.error, ValueError):
+            # Not written by this version of the cache.
+            return None
+        if entry['fingerprint'] != fingerprint:
+            return None
+        return entry['data']
+
+    def set(self, uri, fingerprint, data):
+        try:
+            total = self._set_script(
+                keys=[self._entry_key(uri), self._index_key,
+                      self._sizes_key, self._total_key],
+                args=[uri, self._encode(fingerprint, data), time.time(),
+                      '' if self.timeout is None else self.timeout])
+            if total > self.max_bytes:
+                self._evict(total)
+        except RedisError as e:
+            logger.warning('Activity cache unavailable: {!r}'.format(e))
+
+    def delete(self, uri):
+        self._remove([uri])
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        while True:
+            uris = self.redis.zrange(self._index_key, 0,
+                                     self.eviction_batch - 1)
+            if not uris:
+                break
+            self._remove([uri.decode('utf-8') for uri in uris])
+        self.redis.delete(self._total_key)
+
+    def _evict(self, total):
+        # Entries whose key expired are still indexed, and are evicted in
+        # their turn like the others.
+        while total > self.max_bytes:
+            uris = [uri.decode('utf-8') for uri in self.redis.zrange(
+                self._index_key, 0, self.eviction_batch - 1)]
+            if not uris:
+                break
+            sizes = self.redis.hmget(self._sizes_key, uris)
+            excess = total - self.max_bytes
+            evicted = []
+            for uri, size in zip(uris, sizes):
+                evicted.append(uri)
+                excess -= int(size or 0)
+                if excess <= 0:
+                    break
+            total = self._remove(evicted)
+
+    def _remove(self, uris):
+        return self._remove_script(
+            keys=[self._index_key, self._sizes_key, self._total_key] +
+            [self._entry_key(uri) for uri in uris],
+            args=uris)
+
+    @staticmethod
+    def _encode(fingerprint, data):
+        entry = json.dumps({'fingerprint': fingerprint, 'data': data},
+                           separators=(',', ':'))
+        return zlib.compress(entry.encode('utf-8'))
+
+    @staticmethod
+    def _decode(raw_entry):
+        return json.loads(zlib.decompress(raw_entry).decode('utf-8'))
+
+    @property
+    def _index_key(self):
+        return '{}:INDEX'.format(self.redis_prefix)
+
+    @property
+    def _sizes_key(self):
+        return '{}:SIZES'.format(self.redis_prefix)
+
+    @property
+    def _total_key(self):
+        return '{}:TOTAL'.format(self.redis_prefix)
+
+    def _entry_key(self, uri):
+        return '{}:ENTRY:{}'.format(self.redis_prefix, uri)
@@ -32,6 +32,13 @@ app.conf.update({
     'CELERY_RESULT_BACKEND': CELERY_BROKER_URL,
     'CELERY_SEND_EVENTS': False,
     'CELERY_EVENT_QUEUE_EXPIRES': 60,
+    # Run by the clock process, see Procfile.
+    'CELERYBEAT_SCHEDULE': {
+        'schedule-syncs': {
+            'task': 'datauploader.tasks.schedule_syncs',
+            'schedule': settings.RUNKEEPER_SCHEDULE_PERIOD,
+        },
+    },
 })
 
 
@@ -0,0 +1,108 @@
+"""
+Encodings for the GPS path of fitness activities.
+
+The encoding is set by RUNKEEPER_PATH_ENCODING:
+
+    rows           a list with an object per point (the original encoding)
+    columns        an object with a list per key, all of the same length
+    columns-delta  like columns, but numeric lists hold the differences
+                   between consecutive values, as integers
+
+For example, a path of two points with rows encoding:
+
+    [{'latitude': 52.1, 'longitude': 4.3, 'type': 'start', ...},
+     {'latitude': 52.2, 'longitude': 4.4, 'type': 'end', ...}]
+
+becomes, with columns-delta encoding:
+
+    {'encoding': 'columns-delta',
+     'latitude': [521000000, 1000000],
+     'longitude': [43000000, 1000000],
+     'type': ['start', 'end'],
+     'delta': {'latitude': 7, 'longitude': 7, ...}}
+
+Values of the keys listed in 'delta' are rounded to that many decimals
+before taking differences, so they're stored in units of 10^-decimals.
+Columns holding values that aren't numbers are never delta-encoded.
+
+decode_path turns any of these back into rows.
+"""
+import numbers
+
+PATH_ENCODINGS = ['rows', 'columns', 'columns-delta']
+
+# Decimals kept for delta-encoded columns: about 1 cm for coordinates and
+# altitude, 1 ms for timestamps.
+DELTA_DECIMALS = {
+    'latitude': 7,
+    'longitude': 7,
+    'altitude': 2,
+    'timestamp': 3,
+}
+
+
+def encode_path(path, encoding, keys):
+    """
+    Encode a path, given as a list of dicts with the given keys.
+    """
+    if encoding == 'rows':
+        return path
+    if encoding not in PATH_ENCODINGS:
+        raise ValueError('Unknown path encoding: {}'.format(encoding))
+
+    encoded = {'encoding': encoding}
+    for key in keys:
+        encoded[key] = [point[key] for point in path]
+
+    if encoding == 'columns-delta':
+        encoded['delta'] = {}
+        for key, decimals in DELTA_DECIMALS.items():
+            column = encoded.get(key)
+            if column is None or not all(_is_number(v) for v in column):
+                continue
+            encoded[key] = _delta_encode(column, decimals)
+            encoded['delta'][key] = decimals
+
+    return encoded
+
+
+def decode_path(path):
+    """
+    Return the rows form of a path in any of the encodings.
+    """
+    if isinstance(path, list):
+        return path
+
+    columns = {key: value for key, value in path.items()
+               if key not in ('encoding', 'delta')}
+    for key, decimals in path.get('delta', {}).items():
+        columns[key] = _delta_decode(columns[key], decimals)
+
+    length = len(next(iter(columns.values()))) if columns else 0
+    return [{key: values[i] for key, values in columns.items()}
+            for i in range(length)]
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _delta_encode(values, decimals):
+    scale = 10 ** decimals
+    deltas = []
+    previous = 0
+    for value in values:
+        current = int(round(value * scale))
+        deltas.append(current - previous)
+        previous = current
+    return deltas
+
+
+def _delta_decode(deltas, decimals):
+    scale = 10 ** decimals
+    values = []
+    current = 0
+    for delta in deltas:
+        current += delta
+        values.append(round(current / scale, decimals))
+    return values
@@ -0,0 +1,109 @@
+"""
+Client for the RunKeeper API.
+
+All calls share one keep-alive requests.Session, so connections to RunKeeper
+are reused between calls and between the threads fetching activities. Every
+call also waits for a permit in the "runkeeper" realm of RespectfulRequester
+(registered in settings), so all workers together stay within RunKeeper's
+rate limit.
+
+Responses saying a request was throttled (HTTP 429, or 503 with a Retry-After
+header) make all workers back off through RespectfulRequester.throttled, and
+the request is retried once the realm allows it.
+
+Each member's calls form a flow of the realm, so the realm's budget is shared
+fairly between the members being synced: a member with thousands of
+activities doesn't hold up everyone else. Calls with a higher weight (e.g.
+for syncs a member is waiting for) get a bigger share. Calls made while a
+page is loading should also pass a timeout, so that they give up rather than
+wait for a busy realm.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests_respectful import RespectfulRequester
+
+RUNKEEPER_API_BASE = 'https://api.runkeeper.com'
+RUNKEEPER_REALM = 'runkeeper'
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait given by a Retry-After header, or None.
+
+    The header holds either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RunkeeperClient:
+
+    # Attempts per call, including retries after being throttled.
+    max_attempts = 5
+
+    realm = RUNKEEPER_REALM
+
+    def __init__(self, pool_size, realm=None):
+        if realm is not None:
+            self.realm = realm
+        self.rr = RespectfulRequester()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+
+    def get(self, path, access_token, content_type=None, weight=1,
+            timeout=None):
+        """
+        Return the JSON data at path (e.g. '/user') of the RunKeeper API.
+
+        Raises RequestsRespectfulRateLimitedError if the realm doesn't allow
+        the call within timeout seconds, including retries.
+        """
+        headers = {'Authorization': 'Bearer {}'.format(access_token)}
+        if content_type:
+            headers['Content-Type'] = content_type
+        # The member's flow, without storing their token in Redis.
+        flow = hashlib.sha1(access_token.encode('utf-8')).hexdigest()
+        deadline = None if timeout is None else time.time() + timeout
+
+        for _ in range(self.max_attempts):
+            self.rr.acquire(
+                [self.realm], flow=flow, weight=weight,
+                timeout=None if deadline is None else max(
+                    0, deadline - time.time()))
+            response = self.session.get(RUNKEEPER_API_BASE + path,
+                                        headers=headers)
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After'))
+            if response.status_code != 429 and not (
+                    response.status_code == 503 and retry_after is not None):
+                return response.json()
+            self.rr.throttled([self.realm], retry_after=retry_after)
+
+        response.raise_for_status()
+
+    def get_user(self, access_token, weight=1, timeout=None):
+        return self.get('/user', access_token, weight=weight,
+                        timeout=timeout)
+
+
+# Fetch workers and the prefetch of the next feed page each hold a connection.
+# Code making more calls at once (e.g. the import_users command) should use a
+# client of its own, with a pool to match.
+client = RunkeeperClient(pool_size=settings.RUNKEEPER_FETCH_WORKERS + 1)
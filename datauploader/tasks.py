@@ -4,18 +4,31 @@ These tasks:
   1. delete any current files in OH if they match the planned upload filename
   2. adds a data file
 """
+import hashlib
 import logging
 import json
+import random
 import tempfile
-import requests
 import os
-from celery import shared_task
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from celery import chord, shared_task
+import requests
 from django.conf import settings
+from django.db import transaction
 from open_humans.models import OpenHumansMember
-from datetime import datetime, timedelta
-from ohapi import api
+from main.helpers import invalidate_runkeeper_file
+from main.models import DataFile, DataSourceMember, SyncCheckpoint
+from datetime import datetime, timedelta, timezone
 import arrow
 
+from . import runkeeper, uploads
+from .cache import ActivityCache
+from .paths import encode_path
+from .writers import open_writer, output_extension
+
 # Set up logging.
 logger = logging.getLogger(__name__)
 
@@ -27,6 +40,38 @@ FITNESS_PATH_KEYS = ['latitude', 'longitude', 'altitude', 'timestamp', 'type']
 
 PAGESIZE = '10000'
 
+RUNKEEPER_TIME_FORMAT = '%a, %d %b %Y %H:%M:%S'
+MONTHS = {month: number for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], start=1)}
+
+activity_cache = ActivityCache.from_url(
+    settings.RUNKEEPER_CACHE_REDIS_URL,
+    max_bytes=settings.RUNKEEPER_CACHE_MAX_BYTES,
+    timeout=settings.RUNKEEPER_CACHE_TIMEOUT)
+
+
+def file_hash(filepath, metadata):
+    """
+    Return a SHA-256 hex digest of a file's contents and its metadata.
+    """
+    sha256 = hashlib.sha256(
+        json.dumps(metadata, sort_keys=True).encode('utf-8'))
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def feed_hash(background_items, fitness_items, complete):
+    """
+    Return a SHA-256 hex digest of a year's items in the RunKeeper feeds and
+    whether the year is over.
+    """
+    serialized = json.dumps([background_items, fitness_items, complete],
+                            sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
 
 def data_for_keys(data_dict, data_keys):
     """
@@ -35,11 +80,38 @@ def data_for_keys(data_dict, data_keys):
     return {x: data_dict[x] if x in data_dict else '' for x in data_keys}
 
 
+def parse_runkeeper_time(time_string):
+    """
+    Parse a RunKeeper time, e.g. 'Tue, 1 May 2018 09:43:09'.
+
+    The format is fixed, so it's split by hand, which is a lot faster than
+    strptime. Anything unexpected is left to strptime, which raises a
+    ValueError if the string really doesn't match.
+    """
+    try:
+        weekday, day, month, year, clock = time_string.split(' ')
+        hour, minute, second = clock.split(':')
+        if weekday.endswith(','):
+            return datetime(int(year), MONTHS[month], int(day),
+                            int(hour), int(minute), int(second))
+    except (ValueError, KeyError):
+        pass
+    return datetime.strptime(time_string, RUNKEEPER_TIME_FORMAT)
+
+
 def yearly_items(items):
+    """
+    Group items per year.
+
+    Each year holds (start time, item) pairs, sorted by start time, so items
+    are only parsed once. Also returns the years that are over and the start
+    time of the latest item (None if there are no items).
+    """
     current_year = (datetime.now() - timedelta(days=1)).year
 
     result = {}
     complete_years = []
+    latest = None
 
     for item in items:
         try:
@@ -47,7 +119,7 @@ def yearly_items(items):
         except KeyError:
             time_string = item['timestamp']
 
-        start_time = datetime.strptime(time_string, '%a, %d %b %Y %H:%M:%S')
+        start_time = parse_runkeeper_time(time_string)
 
         if start_time.year not in result:
             result[start_time.year] = []
@@ -55,63 +127,168 @@ def yearly_items(items):
             if start_time.year < current_year:
                 complete_years.append(start_time.year)
 
-        result[start_time.year].append(item)
+        result[start_time.year].append((start_time, item))
+
+        if latest is None or start_time > latest:
+            latest = start_time
+
+    for year_items in result.values():
+        year_items.sort(key=itemgetter(0))
 
-    return result, complete_years
+    return result, complete_years, latest
+
+
+def years_to_update(feed_hashes, watermark, uploaded_feed_hashes):
+    """
+    Return the years that can have changed since the last sync.
+
+    feed_hashes maps each year to the feed_hash of its items now, and
+    uploaded_feed_hashes to the one of its last upload. Without a watermark
+    every year is processed. Otherwise, the year of the watermark and the
+    years after it can hold new activities (or need their 'complete' flag
+    updated). Earlier years are only processed if their items changed, e.g.
+    because an activity was entered for a past date or deleted, or if they
+    were uploaded before they were over.
+    """
+    return sorted(
+        year for year, year_hash in feed_hashes.items()
+        if watermark is None or year >= watermark.year or
+        uploaded_feed_hashes.get(year) != year_hash)
 
 
-def runkeeper_query(path, access_token, content_type=None):
+def runkeeper_query(path, access_token, content_type=None, weight=1):
     """
     Query RunKeeper API and return data.
     """
-    headers = {'Authorization': 'Bearer {}'.format(access_token)}
+    return runkeeper.client.get(path, access_token,
+                                content_type=content_type, weight=weight)
 
-    if content_type:
-        headers['Content-Type'] = content_type
 
-    data_url = 'https://api.runkeeper.com{}'.format(path)
+def fetch_in_order(func, items, max_workers):
+    """
+    Yield func(item) for each item, running up to max_workers calls at once.
 
-    data_response = requests.get(data_url, headers=headers)
-    data = data_response.json()
+    Results are yielded in the order of items. No more than 2 * max_workers
+    calls are submitted ahead of the result being yielded, so memory stays
+    bounded however long items is.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-    return data
 
+def get_fitness_activity(item, access_token, weight=1):
+    """
+    Return the data we keep for a fitness activity feed item.
 
-def get_items(path, access_token, recurse='both'):
+    The activity is only fetched if activity_cache doesn't have it for the
+    item's current metadata.
     """
-    Iterate to get all items for a given access_token and path.
+    fingerprint = activity_cache.fingerprint(item)
+    item_data_out = activity_cache.get(item['uri'], fingerprint)
+    if item_data_out is not None:
+        return item_data_out
+
+    item_data = runkeeper_query(item['uri'], access_token, weight=weight)
+    item_data_out = data_for_keys(item_data, FITNESS_SUMMARY_KEYS)
+    item_data_out['path'] = [
+        data_for_keys(datapoint, FITNESS_PATH_KEYS)
+        for datapoint in item_data['path']]
+    activity_cache.set(item['uri'], fingerprint, item_data_out)
+    return item_data_out
 
-    RunKeeper uses the same pages format for items in various places.
+
+def iter_fetched_activities(checkpoint, items, access_token, weight=1):
     """
-    query_data = runkeeper_query(path, access_token)
-    items = query_data['items']
+    Yield the data of the fitness activity of each feed item, in order.
 
-    if 'previous' in query_data and recurse in ['both', 'prev']:
-        prev_items = get_items(query_data['previous'], access_token,
-                               recurse='prev')
-        items = prev_items + items
+    Activities are read from those stored for the sync of checkpoint, a
+    batch at a time. Any that are missing are fetched, or read from
+    activity_cache, instead.
+    """
+    batch_size = settings.RUNKEEPER_FETCH_CHUNK_SIZE
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        stored = checkpoint.get_fetched_activities(
+            [item['uri'] for item in batch])
+        missing = fetch_in_order(
+            lambda item: get_fitness_activity(
+                item, access_token, weight=weight),
+            [item for item in batch if item['uri'] not in stored],
+            max_workers=settings.RUNKEEPER_FETCH_WORKERS)
+        for item in batch:
+            if item['uri'] in stored:
+                yield stored[item['uri']]
+            else:
+                yield next(missing)
+
+
+def with_path_encoding(activity, path_encoding):
+    """
+    Return a fitness activity with its path in the given encoding.
+    """
+    if path_encoding == 'rows':
+        return activity
+    return dict(activity, path=encode_path(
+        activity['path'], path_encoding, FITNESS_PATH_KEYS))
 
-    if 'next' in query_data and recurse in ['both', 'next']:
-        next_items = get_items(query_data['next'],
-                               access_token,
-                               recurse='next')
-        items = items + next_items
 
-    if recurse == 'both':
-        # Assert we have correct size.
-        if len(items) != query_data['size']:
-            error_msg = ('Activity items for retrieved for {} ({}) '
-                         "doesn't match expected array size ({})").format(
-                             path, len(items), query_data['size'])
-            raise AssertionError(error_msg)
+def iter_items(path, access_token, weight=1):
+    """
+    Yield all items for a given access_token and path, page by page.
 
-    return items
+    RunKeeper uses the same pages format for items in various places. The
+    next page is fetched while the items of the current one are consumed.
+    Raises an AssertionError if the number of items doesn't match the size
+    reported for the feed.
+    """
+    first_page = runkeeper_query(path, access_token, weight=weight)
+
+    # Pages before the requested one (if any) are yielded first.
+    previous_pages = []
+    page = first_page
+    while 'previous' in page:
+        page = runkeeper_query(page['previous'], access_token,
+                               weight=weight)
+        previous_pages.append(page)
+
+    item_count = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for page in reversed(previous_pages):
+            item_count += len(page['items'])
+            yield from page['items']
+
+        page = first_page
+        while True:
+            next_page = None
+            if 'next' in page:
+                next_page = executor.submit(
+                    runkeeper_query, page['next'], access_token,
+                    weight=weight)
+            item_count += len(page['items'])
+            yield from page['items']
+            if next_page is None:
+                break
+            page = next_page.result()
+
+    # Assert we have correct size.
+    if item_count != first_page['size']:
+        error_msg = ('Activity items for retrieved for {} ({}) '
+                     "doesn't match expected array size ({})").format(
+                         path, item_count, first_page['size'])
+        raise AssertionError(error_msg)
 
 
 @shared_task
-def process_runkeeper(oh_id):
+def process_runkeeper(oh_id, full_sync=False, interactive=False):
     """
-    Data is split per-year, in JSON format.
+    Data is split per-year, in JSON format (optionally compressed or
+    newline-delimited, see RUNKEEPER_OUTPUT_FORMAT and writers.py).
     Each JSON is an object (dict) in the following format (pseudocode):
 
     { 'background_activities':
@@ -130,85 +307,351 @@ def process_runkeeper(oh_id):
         ]
     }
 
+    With RUNKEEPER_PATH_ENCODING set to 'columns' or 'columns-delta', each
+    'path' is an object of lists instead (see paths.py, which also has
+    decode_path to get the form above back).
+
     Notes:
         - items are sorted according to start_time or timestamp
         - The item_uri for fitness_activities matches item_uri in
           fitness_activity_sharing.
+        - Unless full_sync is set, only years from the member's
+          sync_watermark onwards, and earlier years whose feed items changed
+          since their last upload (see main.models.DataFile.feed_hash), are
+          fetched and uploaded again.
+        - Files whose contents and metadata match the last upload (see
+          main.models.DataFile) aren't uploaded again. The others are
+          uploaded concurrently, as soon as each year has been written.
+        - The sync is fanned out: this task walks the feeds, activities are
+          fetched by fetch_runkeeper_activities tasks in chunks of
+          RUNKEEPER_FETCH_CHUNK_SIZE, and upload_runkeeper_years writes and
+          uploads the files once all chunks are done.
+        - Progress is kept in a main.models.SyncCheckpoint. Nothing is done
+          while another attempt at the member's sync is alive. A sync started
+          after one died, within RUNKEEPER_CHECKPOINT_MAX_AGE, resumes from
+          its checkpoint: the feeds aren't walked again, and fetched
+          activities and uploaded years are skipped. Tasks of the attempt
+          that died stop once they find out.
+        - The member's next scheduled sync is pushed back by
+          RUNKEEPER_SYNC_RETRY_DELAY when the sync starts, however it was
+          started, and set RUNKEEPER_SYNC_INTERVAL on when it finishes.
+        - RunKeeper calls of interactive syncs (started by the member) get a
+          larger share of the API budget, see RUNKEEPER_INTERACTIVE_WEIGHT.
     """
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
-    oh_access_token = oh_member.get_access_token(
-                            client_id=settings.OPENHUMANS_CLIENT_ID,
-                            client_secret=settings.OPENHUMANS_CLIENT_SECRET)
     runkeeper_member = oh_member.datasourcemember
     print('start processing data for {}'.format(
                             runkeeper_member.runkeeper_id))
 
+    weight = settings.RUNKEEPER_INTERACTIVE_WEIGHT if interactive else 1
+
+    checkpoint = SyncCheckpoint.claim(runkeeper_member, full_sync)
+    if checkpoint is None:
+        print('sync of {} already in progress'.format(
+            runkeeper_member.runkeeper_id))
+        return
+    attempt = checkpoint.attempt
+    # Like schedule_syncs does, so that it doesn't start another sync of the
+    # member while this one runs (e.g. one started from the dashboard), and
+    # retries it if it fails.
+    DataSourceMember.objects.filter(pk=runkeeper_member.pk).update(
+        next_sync_at=arrow.now().datetime + timedelta(
+            seconds=settings.RUNKEEPER_SYNC_RETRY_DELAY))
+
+    if checkpoint.plan:
+        print('resuming sync started at {}'.format(checkpoint.started_at))
+        plan = checkpoint.get_plan()
+    else:
+        try:
+            plan = plan_sync(runkeeper_member, full_sync, weight)
+        except Exception:
+            # Leave the sync to the next attempt straight away.
+            SyncCheckpoint.finish(runkeeper_member, attempt)
+            raise
+        if not SyncCheckpoint.beat(runkeeper_member, attempt,
+                                   plan=json.dumps(plan)):
+            return
+    fetched_uris = checkpoint.get_fetched_uris()
+    uploaded_years = checkpoint.get_uploaded_years()
+
+    # Fetch activities in parallel, then write and upload the files.
+    chunk_size = settings.RUNKEEPER_FETCH_CHUNK_SIZE
+    fetches = []
+    for year in plan['years']:
+        if year['year'] in uploaded_years:
+            continue
+        items = [item for item in year['fitness_items']
+                 if item['uri'] not in fetched_uris]
+        fetches.extend(
+            fetch_runkeeper_activities.si(
+                oh_id, attempt, items[i:i + chunk_size], weight)
+            for i in range(0, len(items), chunk_size))
+    upload = upload_runkeeper_years.si(oh_id, attempt, weight)
+    if fetches:
+        chord(fetches)(upload)
+    else:
+        upload.delay()
+
+
+def plan_sync(runkeeper_member, full_sync=False, weight=1):
+    """
+    Walk a member's feeds and return the plan of their sync.
+
+    The plan is JSON-serializable, for SyncCheckpoint.plan: a dict with
+    'years', the data of the years to upload, 'new_watermark', the
+    sync_watermark once they're uploaded, and 'full_sync'.
+    """
     access_token = runkeeper_member.access_token
-    user_data = runkeeper_query('/user', access_token)
-    runkeeper_member.runkeeper_id = user_data['userID']
+    user_data = runkeeper_query('/user', access_token, weight=weight)
 
     # Get activity data.
     fitness_activity_path = '{}?pageSize={}'.format(
         user_data['fitness_activities'], PAGESIZE)
-    fitness_activity_items, complete_fitness_activity_years = yearly_items(
-        get_items(path=fitness_activity_path, access_token=access_token))
+    (fitness_activity_items, complete_fitness_activity_years,
+     latest_fitness_activity) = yearly_items(
+        iter_items(fitness_activity_path, access_token, weight=weight))
 
     # Background activities.
     background_activ_path = '{}?pageSize={}'.format(
         user_data['background_activities'], PAGESIZE)
-    background_activ_items, complete_background_activ_years = yearly_items(
-        get_items(background_activ_path, access_token))
+    (background_activ_items, complete_background_activ_years,
+     latest_background_activ) = yearly_items(
+        iter_items(background_activ_path, access_token, weight=weight))
 
-    all_years = sorted(set(list(fitness_activity_items.keys()) +
-                           list(background_activ_items.keys())))
+    all_years = set(list(fitness_activity_items.keys()) +
+                    list(background_activ_items.keys()))
     all_completed_years = set(
         complete_fitness_activity_years + complete_background_activ_years)
 
-    for year in all_years:
-        outdata = {'fitness_activities': [],
-                   'background_activities': []}
-
-        fitness_items = sorted(
-            fitness_activity_items.get(year, []),
-            key=lambda item: datetime.strptime(
-                item['start_time'], '%a, %d %b %Y %H:%M:%S'))
-        for item in fitness_items:
-            item_data = runkeeper_query(item['uri'], access_token)
-            item_data_out = data_for_keys(item_data, FITNESS_SUMMARY_KEYS)
-            item_data_out['path'] = [
-                data_for_keys(datapoint, FITNESS_PATH_KEYS)
-                for datapoint in item_data['path']]
-            outdata['fitness_activities'].append(item_data_out)
-        background_items = sorted(
-            background_activ_items.get(year, []),
-            key=lambda item: datetime.strptime(
-                item['timestamp'], '%a, %d %b %Y %H:%M:%S'))
-
-        for item in background_items:
-            outdata['background_activities'].append(
-                data_for_keys(item, BACKGROUND_DATA_KEYS))
-
-        filename = 'Runkeeper-activity-data-{}.json'.format(str(year))
-        temp_directory = tempfile.mkdtemp()
-        filepath = os.path.join(temp_directory, filename)
-        with open(filepath, 'w') as f:
-            json.dump(outdata, f, indent=2, sort_keys=True)
-            f.flush()
-
-        metadata = {
-            'description': ('Runkeeper GPS maps and imported '
-                            'activity data.'),
-            'tags': ['GPS', 'Runkeeper'],
-            'dataYear': year,
-            'complete': year in all_completed_years,
-        }
-        api.delete_file(oh_member.access_token,
-                        oh_member.oh_id,
-                        file_basename=filename)
-        api.upload_aws(filepath, metadata,
-                       oh_access_token,
-                       project_member_id=oh_member.oh_id)
-    runkeeper_member.last_updated = arrow.now().format()
-    runkeeper_member.save()
+    all_items = {year: (
+        [item for _, item in background_activ_items.get(year, [])],
+        [item for _, item in fitness_activity_items.get(year, [])])
+        for year in all_years}
+    feed_hashes = {year: feed_hash(*items,
+                                   complete=year in all_completed_years)
+                   for year, items in all_items.items()}
+    uploaded_feed_hashes = dict(
+        runkeeper_member.data_files.values_list('year', 'feed_hash'))
+
+    watermark = None if full_sync else runkeeper_member.sync_watermark
+    years = [{
+        'year': year,
+        'complete': year in all_completed_years,
+        'background_items': all_items[year][0],
+        'fitness_items': all_items[year][1],
+        'feed_hash': feed_hashes[year],
+    } for year in years_to_update(
+        feed_hashes, watermark, uploaded_feed_hashes)]
+
+    latest_activities = [t for t in (latest_fitness_activity,
+                                     latest_background_activ) if t]
+    # RunKeeper reports local times; they're stored as if they were UTC.
+    new_watermark = max(latest_activities).replace(
+        tzinfo=timezone.utc).isoformat() if latest_activities else None
+
+    return {'years': years, 'new_watermark': new_watermark,
+            'full_sync': full_sync}
+
+
+@shared_task(autoretry_for=(requests.RequestException, ValueError),
+             retry_backoff=True, max_retries=5)
+def fetch_runkeeper_activities(oh_id, attempt, items, weight=1):
+    """
+    Fetch the fitness activities of feed items, for the given attempt at the
+    member's sync, and store them for upload_runkeeper_years (see
+    main.models.FetchedActivity).
+
+    Retried with backoff if RunKeeper fails; activities fetched before the
+    failure are in activity_cache by then, so they aren't fetched again.
+    Nothing is fetched once the attempt doesn't run the sync anymore.
+    """
+    runkeeper_member = DataSourceMember.objects.get(user__oh_id=oh_id)
+    if not SyncCheckpoint.beat(runkeeper_member, attempt):
+        return 0
+    access_token = runkeeper_member.access_token
+    activities = dict(fetch_in_order(
+        lambda item: (item['uri'], get_fitness_activity(
+            item, access_token, weight=weight)),
+        items, max_workers=settings.RUNKEEPER_FETCH_WORKERS))
+    SyncCheckpoint.add_fetched_activities(runkeeper_member, attempt,
+                                          activities)
+    return len(activities)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+def upload_runkeeper_years(oh_id, attempt, weight=1):
+    """
+    Write and upload the yearly files in the plan of the member's sync, for
+    the given attempt at it.
+
+    Fitness activities are read from where fetch_runkeeper_activities
+    stored them (they're fetched again if they're missing). Each uploaded
+    year is recorded in the SyncCheckpoint, so a retry only uploads the
+    others. Once all files are uploaded, the member's sync_watermark is
+    moved on and the checkpoint is deleted. No more files are uploaded once
+    the attempt doesn't run the sync anymore.
+    """
+    oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+    oh_access_token = oh_member.get_access_token(
+                            client_id=settings.OPENHUMANS_CLIENT_ID,
+                            client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+    runkeeper_member = oh_member.datasourcemember
+    access_token = runkeeper_member.access_token
+    checkpoint = SyncCheckpoint.objects.filter(
+        member=runkeeper_member, attempt=attempt).first()
+    if checkpoint is None:
+        # Finished or taken over by another attempt.
+        return
+    plan = checkpoint.get_plan()
+    uploaded_years = checkpoint.get_uploaded_years()
+
+    data_files = {data_file.year: data_file
+                  for data_file in runkeeper_member.data_files.all()}
+    output_format = settings.RUNKEEPER_OUTPUT_FORMAT
+    path_encoding = settings.RUNKEEPER_PATH_ENCODING
+
+    # Finished years are uploaded in the background while the following
+    # years are being written.
+    pending_uploads = []
+    taken_over = False
+    with ThreadPoolExecutor(
+            max_workers=settings.OH_UPLOAD_WORKERS) as upload_pool:
+        for planned_year in plan['years']:
+            year = planned_year['year']
+            if year in uploaded_years:
+                continue
+            if not SyncCheckpoint.beat(runkeeper_member, attempt):
+                taken_over = True
+                break
+            filename = 'Runkeeper-activity-data-{}{}'.format(
+                year, output_extension(output_format))
+            temp_directory = tempfile.mkdtemp()
+            filepath = os.path.join(temp_directory, filename)
+            with open_writer(filepath, output_format) as writer:
+                # Activities are written as soon as they're read, so only
+                # a few of them are in memory at any time.
+                writer.write_collection(
+                    'background_activities',
+                    (data_for_keys(item, BACKGROUND_DATA_KEYS)
+                     for item in planned_year['background_items']))
+                fitness_activities = iter_fetched_activities(
+                    checkpoint, planned_year['fitness_items'],
+                    access_token, weight=weight)
+                writer.write_collection(
+                    'fitness_activities',
+                    (with_path_encoding(activity, path_encoding)
+                     for activity in fitness_activities))
+
+            metadata = {
+                'description': ('Runkeeper GPS maps and imported '
+                                'activity data.'),
+                'tags': ['GPS', 'Runkeeper'],
+                'dataYear': year,
+                'complete': planned_year['complete'],
+                'format': output_format,
+                'pathEncoding': path_encoding,
+            }
+            content_hash = file_hash(filepath, metadata)
+            year_feed_hash = planned_year.get('feed_hash', '')
+            if (year in data_files and
+                    data_files[year].content_hash == content_hash):
+                print('{} unchanged, not uploading'.format(filename))
+                shutil.rmtree(temp_directory)
+                if data_files[year].feed_hash != year_feed_hash:
+                    data_files[year].feed_hash = year_feed_hash
+                    data_files[year].save(update_fields=['feed_hash'])
+                SyncCheckpoint.add_uploaded_year(runkeeper_member, attempt,
+                                                 year)
+                continue
+
+            # Files written in a different format have another name.
+            replaced_basename = (
+                data_files[year].basename if year in data_files else None)
+            upload = upload_pool.submit(
+                uploads.replace_file, filepath, metadata,
+                oh_access_token, oh_member.oh_id,
+                replaced_basename=replaced_basename)
+            pending_uploads.append((upload, year, filename, content_hash,
+                                    year_feed_hash, temp_directory))
+
+    upload_errors = []
+    for (upload, year, filename, content_hash, year_feed_hash,
+         temp_directory) in pending_uploads:
+        shutil.rmtree(temp_directory)
+        try:
+            upload.result()
+        except Exception as e:
+            upload_errors.append(e)
+            continue
+        DataFile.objects.update_or_create(
+            member=runkeeper_member, year=year,
+            defaults={'basename': filename, 'content_hash': content_hash,
+                      'feed_hash': year_feed_hash})
+        SyncCheckpoint.add_uploaded_year(runkeeper_member, attempt, year)
+    if pending_uploads:
+        # Files were replaced, with new download URLs.
+        invalidate_runkeeper_file(oh_id)
+    if upload_errors:
+        raise upload_errors[0]
+
+    with transaction.atomic():
+        if taken_over or not SyncCheckpoint.finish(runkeeper_member,
+                                                   attempt):
+            print('sync of {} taken over by another attempt'.format(
+                runkeeper_member.runkeeper_id))
+            return
+        if plan['new_watermark']:
+            runkeeper_member.sync_watermark = arrow.get(
+                plan['new_watermark']).datetime
+        runkeeper_member.last_updated = arrow.now().format()
+        runkeeper_member.schedule_next_sync()
+        runkeeper_member.save()
     print('finished processing data for {}'.format(
                             runkeeper_member.runkeeper_id))
+
+
+def schedule_batch_size(period):
+    """
+    Return how many members can be synced in period seconds within the share
+    of the RunKeeper rate limit given to scheduled syncs.
+    """
+    budget = (settings.RUNKEEPER_RATE_LIMIT * period / 60 *
+              settings.RUNKEEPER_SCHEDULE_SHARE)
+    return max(1, int(budget / settings.RUNKEEPER_SYNC_COST))
+
+
+@shared_task
+def schedule_syncs():
+    """
+    Start syncs of the members that are due, spread over the next period.
+
+    Run every RUNKEEPER_SCHEDULE_PERIOD seconds by celery beat. Each member
+    gets an even slot of the period, and starts at a random time within it,
+    so the load on RunKeeper stays flat rather than coming in bursts. The
+    members are scheduled again for RUNKEEPER_SYNC_RETRY_DELAY later straight
+    away, so that a failed sync is retried (and resumed, see
+    process_runkeeper) then. A successful sync schedules the next one
+    RUNKEEPER_SYNC_INTERVAL after it finishes.
+    """
+    period = settings.RUNKEEPER_SCHEDULE_PERIOD
+    now = arrow.now().datetime
+    due = list(DataSourceMember.objects.due_for_sync(
+        now=now, limit=schedule_batch_size(period)).values_list(
+            'pk', 'user__oh_id'))
+    if not due:
+        return 0
+
+    DataSourceMember.objects.filter(pk__in=[pk for pk, _ in due]).update(
+        next_sync_at=now + timedelta(
+            seconds=settings.RUNKEEPER_SYNC_RETRY_DELAY))
+    # Tokens that would expire before the syncs are done are refreshed now,
+    # rather than by the sync's tasks.
+    OpenHumansMember.refresh_expiring_tokens(
+        [oh_id for _, oh_id in due], min_valid=period + 3600)
+
+    slot = period / len(due)
+    for i, (_, oh_id) in enumerate(due):
+        process_runkeeper.apply_async(
+            (oh_id,), countdown=(i + random.random()) * slot)
+    logger.info('Scheduled syncs for {} members'.format(len(due)))
+    return len(due)
@@ -0,0 +1,78 @@
+"""
+Uploads of data files to Open Humans.
+
+These send the same requests as ohapi.api.delete_file and
+ohapi.api.upload_aws, but through one shared requests.Session, so that the
+connections to Open Humans and S3 are reused between files and between the
+threads uploading them.
+"""
+import json
+import logging
+import os
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from ohapi.api import handle_error
+
+logger = logging.getLogger(__name__)
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=settings.OH_UPLOAD_WORKERS))
+
+
+def delete_file(access_token, project_member_id, file_basename):
+    """
+    Delete a member's project files matching file_basename.
+    """
+    response = session.post(
+        settings.OH_DELETE_FILES,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'file_basename': file_basename})
+    handle_error(response, 200)
+    return response
+
+
+def upload_file(filepath, metadata, access_token, project_member_id):
+    """
+    Upload a file to a member's project files with the direct upload API.
+    """
+    filename = os.path.basename(filepath)
+    response = session.post(
+        settings.OH_DIRECT_UPLOAD,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'metadata': json.dumps(metadata),
+              'filename': filename})
+    handle_error(response, 201)
+    upload = response.json()
+
+    with open(filepath, 'rb') as f:
+        response = session.put(upload['url'], data=f)
+    handle_error(response, 200)
+
+    response = session.post(
+        settings.OH_DIRECT_UPLOAD_COMPLETE,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'file_id': upload['id']})
+    handle_error(response, 200)
+    logger.info('Upload complete: {}'.format(filename))
+    return response
+
+
+def replace_file(filepath, metadata, access_token, project_member_id,
+                 replaced_basename=None):
+    """
+    Replace a member's project file by a new upload of filepath.
+
+    replaced_basename is deleted as well, if the file being replaced was
+    uploaded under a different name.
+    """
+    basename = os.path.basename(filepath)
+    delete_file(access_token, project_member_id, file_basename=basename)
+    if replaced_basename and replaced_basename != basename:
+        delete_file(access_token, project_member_id,
+                    file_basename=replaced_basename)
+    return upload_file(filepath, metadata, access_token, project_member_id)
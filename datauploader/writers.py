@@ -0,0 +1,133 @@
+"""
+Writers for the yearly data files uploaded to Open Humans.
+
+Activities are written as they come in, so only one activity needs to be
+held in memory while a year is being processed.
+
+The format of the files is set by RUNKEEPER_OUTPUT_FORMAT, one of the keys of
+OUTPUT_FORMATS:
+
+    json         pretty-printed JSON (the original format)
+    json-compact JSON without whitespace
+    json-gzip    JSON without whitespace, gzip compressed
+    ndjson-gzip  one JSON object per activity per line, gzip compressed
+"""
+from contextlib import contextmanager
+import gzip
+import io
+import json
+
+
+class YearlyJSONWriter:
+    """
+    Write a yearly JSON file one activity at a time.
+
+    Collections must be written in key order. The resulting file is the same
+    as the output of json.dump(outdata, f, indent=indent, sort_keys=True) for
+    a dict with the collections as keys, or as compact as possible if indent
+    is None:
+
+        writer = YearlyJSONWriter(f)
+        writer.write_collection('background_activities', background_items)
+        writer.write_collection('fitness_activities', fitness_items)
+        writer.close()
+    """
+
+    def __init__(self, fileobj, indent=2):
+        self.fileobj = fileobj
+        self.indent = indent
+        if indent is None:
+            self.key_separator = ':'
+            self.collection_newline = ''
+            self.item_newline = ''
+        else:
+            self.key_separator = ': '
+            self.collection_newline = '\n' + ' ' * indent
+            self.item_newline = '\n' + ' ' * 2 * indent
+        self.collection = None
+        self.fileobj.write('{')
+
+    def write_collection(self, name, items):
+        if self.collection is not None and name <= self.collection:
+            raise ValueError('Collection {} written after {}'.format(
+                name, self.collection))
+        if self.collection is not None:
+            self.fileobj.write(',')
+        self.fileobj.write('{}{}{}['.format(
+            self.collection_newline, json.dumps(name), self.key_separator))
+        self.collection = name
+
+        empty = True
+        for item in items:
+            if not empty:
+                self.fileobj.write(',')
+            self.fileobj.write(self.item_newline)
+            self.fileobj.write(self._dumps(item))
+            empty = False
+        if not empty:
+            self.fileobj.write(self.collection_newline)
+        self.fileobj.write(']')
+
+    def close(self):
+        if self.indent is not None and self.collection is not None:
+            self.fileobj.write('\n')
+        self.fileobj.write('}')
+
+    def _dumps(self, item):
+        if self.indent is None:
+            return json.dumps(item, sort_keys=True, separators=(',', ':'))
+        return json.dumps(item, indent=self.indent, sort_keys=True).replace(
+            '\n', self.item_newline)
+
+
+class YearlyNDJSONWriter:
+    """
+    Write a yearly newline-delimited JSON file, one activity per line.
+
+    Each line is the activity's object, with a 'collection' key naming the
+    collection it belongs to (e.g. 'fitness_activities').
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write_collection(self, name, items):
+        for item in items:
+            line = dict(item, collection=name)
+            self.fileobj.write(json.dumps(line, sort_keys=True,
+                                          separators=(',', ':')))
+            self.fileobj.write('\n')
+
+    def close(self):
+        pass
+
+
+# Format name: (file extension, gzip compressed, writer, writer options)
+OUTPUT_FORMATS = {
+    'json': ('.json', False, YearlyJSONWriter, {'indent': 2}),
+    'json-compact': ('.json', False, YearlyJSONWriter, {'indent': None}),
+    'json-gzip': ('.json.gz', True, YearlyJSONWriter, {'indent': None}),
+    'ndjson-gzip': ('.ndjson.gz', True, YearlyNDJSONWriter, {}),
+}
+
+
+def output_extension(output_format):
+    return OUTPUT_FORMATS[output_format][0]
+
+
+@contextmanager
+def open_writer(filepath, output_format):
+    """
+    Open filepath for writing in the given format and yield its writer.
+    """
+    _, compressed, writer_class, options = OUTPUT_FORMATS[output_format]
+    with open(filepath, 'wb') as f:
+        # No timestamp in the gzip header: unchanged data must result in an
+        # identical file, so that it isn't uploaded again.
+        stream = gzip.GzipFile(fileobj=f, mode='wb', mtime=0) \
+            if compressed else f
+        text = io.TextIOWrapper(stream, encoding='utf-8')
+        writer = writer_class(text, **options)
+        yield writer
+        writer.close()
+        text.close()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+from urllib.parse import urlparse
 import dj_database_url
 from env_tools import apply_env
 from requests_respectful import RespectfulRequester
@@ -55,13 +56,92 @@ OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
 OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
 
+# Number of yearly files uploaded to Open Humans concurrently during a sync.
+OH_UPLOAD_WORKERS = int(os.getenv('OH_UPLOAD_WORKERS', 3))
+
+# Seconds a token refresh waits for Open Humans. Other callers wait for the
+# member's refresh meanwhile, see OpenHumansMember.get_access_token.
+OH_TOKEN_REFRESH_TIMEOUT = int(os.getenv('OH_TOKEN_REFRESH_TIMEOUT', 10))
+
 RUNKEEPER_CLIENT_ID = os.getenv('RUNKEEPER_CLIENT_ID')
 RUNKEEPER_CLIENT_SECRET = os.getenv('RUNKEEPER_CLIENT_SECRET')
 RUNKEEPER_REDIRECT_URI = os.getenv('RUNKEEPER_REDIRECT_URI')
 
+# Number of RunKeeper activities fetched concurrently during a sync. All of
+# them still go through the "runkeeper" realm below.
+RUNKEEPER_FETCH_WORKERS = int(os.getenv('RUNKEEPER_FETCH_WORKERS', 4))
+
+# Activities fetched per fetch_runkeeper_activities task. A member's sync is
+# split into tasks of this many activities, which any worker can pick up.
+RUNKEEPER_FETCH_CHUNK_SIZE = int(os.getenv('RUNKEEPER_FETCH_CHUNK_SIZE', 100))
+
+# Time between the scheduled syncs of a member, in seconds.
+RUNKEEPER_SYNC_INTERVAL = int(
+    os.getenv('RUNKEEPER_SYNC_INTERVAL', 4 * 24 * 3600))
+
+# Time after which a scheduled sync that didn't finish is started again, and
+# the age up to which a new sync resumes from the checkpoint of an unfinished
+# one (see main.models.SyncCheckpoint), in seconds.
+RUNKEEPER_SYNC_RETRY_DELAY = int(
+    os.getenv('RUNKEEPER_SYNC_RETRY_DELAY', 6 * 3600))
+RUNKEEPER_CHECKPOINT_MAX_AGE = int(
+    os.getenv('RUNKEEPER_CHECKPOINT_MAX_AGE', 24 * 3600))
+
+# Seconds after which a sync whose tasks stopped recording progress is taken
+# to have died. Until then, new syncs of the member aren't started; after, the
+# next one resumes from its checkpoint. Fetch tasks waiting in the queue don't
+# record progress, so this should be well above the time they can wait.
+RUNKEEPER_SYNC_STALE_AFTER = int(
+    os.getenv('RUNKEEPER_SYNC_STALE_AFTER', 3600))
+
+# Requests per minute allowed by RunKeeper, for the "runkeeper" realm below.
+RUNKEEPER_RATE_LIMIT = int(os.getenv('RUNKEEPER_RATE_LIMIT', 60))
+
+# Scheduled syncs (see datauploader.tasks.schedule_syncs) are started every
+# RUNKEEPER_SCHEDULE_PERIOD seconds, spread over the period. They're sized to
+# use RUNKEEPER_SCHEDULE_SHARE of the rate limit, assuming a sync makes
+# RUNKEEPER_SYNC_COST requests on average; the rest is left for syncs that
+# members start themselves.
+RUNKEEPER_SCHEDULE_PERIOD = int(os.getenv('RUNKEEPER_SCHEDULE_PERIOD', 600))
+RUNKEEPER_SCHEDULE_SHARE = float(os.getenv('RUNKEEPER_SCHEDULE_SHARE', 0.5))
+RUNKEEPER_SYNC_COST = int(os.getenv('RUNKEEPER_SYNC_COST', 10))
+
+# Members share the "runkeeper" realm fairly. Syncs a member started from the
+# dashboard get this many times the share of background syncs.
+RUNKEEPER_INTERACTIVE_WEIGHT = int(
+    os.getenv('RUNKEEPER_INTERACTIVE_WEIGHT', 4))
+
+# Seconds a page waits for the "runkeeper" realm before giving up, well
+# within the router's timeout for web requests.
+RUNKEEPER_INTERACTIVE_TIMEOUT = int(
+    os.getenv('RUNKEEPER_INTERACTIVE_TIMEOUT', 10))
+
+# Format of the yearly files uploaded to Open Humans: 'json' (pretty-printed),
+# 'json-compact', 'json-gzip' or 'ndjson-gzip'. See datauploader/writers.py.
+RUNKEEPER_OUTPUT_FORMAT = os.getenv('RUNKEEPER_OUTPUT_FORMAT', 'json')
+
+# Encoding of GPS paths in those files: 'rows' (an object per point),
+# 'columns' or 'columns-delta'. See datauploader/paths.py.
+RUNKEEPER_PATH_ENCODING = os.getenv('RUNKEEPER_PATH_ENCODING', 'rows')
+
+# Redis cache for the data kept from RunKeeper activities, so that syncs only
+# fetch activities that are new or changed. It's kept apart from the Redis of
+# the task queue (REDIS_URL), so that filling it can't affect the queue: by
+# default it's database 2 of the same server. Syncs don't depend on it; if it
+# can't be reached, activities are fetched from RunKeeper instead.
+# Least recently used entries are evicted once their compressed size exceeds
+# RUNKEEPER_CACHE_MAX_BYTES.
+RUNKEEPER_CACHE_REDIS_URL = os.getenv(
+    'RUNKEEPER_CACHE_REDIS_URL',
+    urlparse(os.getenv('REDIS_URL', 'redis://localhost:6379'))._replace(
+        path='/2').geturl())
+RUNKEEPER_CACHE_MAX_BYTES = int(
+    os.getenv('RUNKEEPER_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RUNKEEPER_CACHE_TIMEOUT = int(
+    os.getenv('RUNKEEPER_CACHE_TIMEOUT', 90 * 24 * 3600))
+
 # Requests Respectful (rate limiting, waiting)
 if REMOTE is True:
-    from urllib.parse import urlparse
     url_object = urlparse(os.getenv('REDIS_URL', 'redis://'))
     RespectfulRequester.configure(
         redis={
@@ -72,9 +152,12 @@ if REMOTE is True:
         },
         safety_threshold=5)
 
-# This creates a Realm called "source" that allows 60 requests per minute maximum.
+# This creates a Realm called "runkeeper" that allows RUNKEEPER_RATE_LIMIT
+# requests per minute maximum. register_realm leaves an existing realm alone,
+# so it's updated as well, to pick up changes of RUNKEEPER_RATE_LIMIT.
 rr = RespectfulRequester()
-rr.register_realm("runkeeper", max_requests=60, timespan=60)
+rr.register_realm("runkeeper", max_requests=RUNKEEPER_RATE_LIMIT, timespan=60)
+rr.update_realm("runkeeper", max_requests=RUNKEEPER_RATE_LIMIT, timespan=60)
 
 # Applications installed
 INSTALLED_APPS = [
@@ -138,6 +221,20 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Shared by the web and worker processes, so that workers can invalidate
+# what the dashboard cached. The table is created by the release step (see
+# Procfile).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
+# Seconds the dashboard's listing of a member's files on Open Humans is
+# cached. Uploads and removals clear it straight away.
+OH_FILE_LIST_CACHE_TIMEOUT = int(os.getenv('OH_FILE_LIST_CACHE_TIMEOUT', 600))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
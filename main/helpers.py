@@ -1,10 +1,26 @@
 from ohapi import api
 from django.conf import settings
+from django.core.cache import cache
 import arrow
 from datetime import timedelta
 
 
+def runkeeper_file_cache_key(oh_id):
+    return 'runkeeper-files-{}'.format(oh_id)
+
+
 def get_runkeeper_file(oh_member):
+    """
+    Return the member's Runkeeper files on Open Humans, as a dict of download
+    URLs by basename, or 'error'.
+
+    Listings are cached for OH_FILE_LIST_CACHE_TIMEOUT seconds, or until
+    invalidate_runkeeper_file is called when the files change.
+    """
+    cache_key = runkeeper_file_cache_key(oh_member.oh_id)
+    files = cache.get(cache_key)
+    if files is not None:
+        return files
     try:
         oh_access_token = oh_member.get_access_token(
                             client_id=settings.OPENHUMANS_CLIENT_ID,
@@ -14,9 +30,14 @@ def get_runkeeper_file(oh_member):
         for dfile in user_object['data']:
             if 'Runkeeper' in dfile['metadata']['tags']:
                 files[dfile['basename']] = dfile['download_url']
-        return files
     except:
         return 'error'
+    cache.set(cache_key, files, settings.OH_FILE_LIST_CACHE_TIMEOUT)
+    return files
+
+
+def invalidate_runkeeper_file(oh_id):
+    cache.delete(runkeeper_file_cache_key(oh_id))
 
 
 def check_update(runkeeper_member):
@@ -1,10 +1,20 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+import logging
+
+from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
-from open_humans.models import OpenHumansMember
+from django.db import IntegrityError, transaction
+from open_humans.models import OpenHumansMember, make_unique_usernames
 from main.models import DataSourceMember
 from django.conf import settings
-from datauploader.tasks import process_runkeeper
-import requests
-#import vcr
+from datauploader.runkeeper import RunkeeperClient
+from datauploader.tasks import schedule_batch_size
+import arrow
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
@@ -15,37 +25,197 @@ class Command(BaseCommand):
                             help='CSV with project_member_id & refresh_token')
         parser.add_argument('--delimiter', type=str,
                             help='CSV delimiter')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Members imported at once')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Members whose tokens are refreshed and '
+                                 'profiles looked up concurrently')
+        parser.add_argument('--stagger', type=float,
+                            help='Seconds between the first syncs of '
+                                 'consecutive members (by default, the '
+                                 'pace at which schedule_syncs starts them)')
 
-    # @vcr.use_cassette('import_users.yaml', decode_compressed_response=True)
     def handle(self, *args, **options):
-        for line in open(options['infile']):
-            line = line.strip().split(options['delimiter'])
-            oh_id = line[0]
-            oh_refresh_token = line[1]
-            runkeeper_access_token = line[2]
-            if len(OpenHumansMember.objects.filter(
-                     oh_id=oh_id)) == 0:
-                oh_member = OpenHumansMember.create(
-                                    oh_id=oh_id,
-                                    access_token="mock",
-                                    refresh_token=oh_refresh_token,
-                                    expires_in=-3600)
-                oh_member.save()
-                oh_member._refresh_tokens(
-                    client_id=settings.OPENHUMANS_CLIENT_ID,
-                    client_secret=settings.OPENHUMANS_CLIENT_SECRET)
-                oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
-
-                headers = {'Authorization': 'Bearer {}'.format(
-                            runkeeper_access_token)}
-                profile_url = 'https://api.runkeeper.com/user'
-                profile_response = requests.get(profile_url, headers=headers)
-                user_data = profile_response.json()
-                runkeeper_id = user_data['userID']
-
-                runkeeper_member = DataSourceMember(
-                    access_token=runkeeper_access_token,
-                    runkeeper_id=runkeeper_id)
-                runkeeper_member.user = oh_member
-                runkeeper_member.save()
-                process_runkeeper.delay(oh_member.oh_id)
+        batch_size = options.get('batch_size') or 500
+        stagger = options.get('stagger')
+        if stagger is None:
+            period = settings.RUNKEEPER_SCHEDULE_PERIOD
+            stagger = period / schedule_batch_size(period)
+        # Syncs are left to schedule_syncs rather than queued here, so that
+        # they don't sit in the broker for hours and are started at a pace
+        # the rate limit allows, along with those of existing members.
+        next_sync_at = arrow.now().datetime
+        totals = Counter()
+        workers = options.get('workers') or 8
+        # The shared client's connection pool is sized for sync tasks.
+        self.runkeeper_client = RunkeeperClient(pool_size=workers)
+        # The file is read a batch at a time, so it can be any size.
+        with open(options['infile']) as infile, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = (line.strip().split(options['delimiter'])
+                    for line in infile if line.strip())
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                counts = self.import_batch(batch, executor, next_sync_at,
+                                           stagger)
+                next_sync_at += timedelta(
+                    seconds=counts['imported'] * stagger)
+                totals.update(counts)
+                print('{} lines read: {} imported, {} already imported, '
+                      '{} failed'.format(totals['read'], totals['imported'],
+                                         totals['existing'],
+                                         totals['failed']))
+        print('first syncs of imported members scheduled until {}'.format(
+            next_sync_at))
+
+    def import_batch(self, batch, executor, first_sync_at, stagger):
+        """
+        Import a batch of CSV rows.
+
+        The new members' first syncs are scheduled stagger seconds apart
+        from first_sync_at, and started by schedule_syncs.
+        """
+        counts = Counter(read=len(batch))
+        rows = {}
+        for row in batch:
+            rows.setdefault(row[0], row)
+        existing = set(OpenHumansMember.objects.filter(
+            oh_id__in=rows).values_list('oh_id', flat=True))
+        counts['existing'] = len(batch) - len(rows) + len(existing)
+        new_rows = [row for oh_id, row in rows.items()
+                    if oh_id not in existing]
+
+        # Refreshing a member's Open Humans token uses up the refresh token
+        # in the file, so it's only done for members that will be created:
+        # their RunKeeper profile is looked up first, and rows for RunKeeper
+        # accounts that are taken (or come up earlier in the batch) are
+        # skipped. Both steps are network-bound; RunKeeper calls still go
+        # through the rate limiter.
+        looked_up = []
+        for row, runkeeper_id in zip(
+                new_rows, executor.map(self.lookup_runkeeper_id, new_rows)):
+            if runkeeper_id is None:
+                counts['failed'] += 1
+            else:
+                looked_up.append((row, runkeeper_id))
+        taken_runkeeper_ids = set(DataSourceMember.objects.filter(
+            runkeeper_id__in=[runkeeper_id for _, runkeeper_id in looked_up]
+        ).values_list('runkeeper_id', flat=True))
+        to_refresh = []
+        for row, runkeeper_id in looked_up:
+            if runkeeper_id in taken_runkeeper_ids:
+                counts['existing'] += 1
+                continue
+            taken_runkeeper_ids.add(runkeeper_id)
+            to_refresh.append((row, runkeeper_id))
+
+        members = []
+        for member in executor.map(lambda args: self.refresh_member(*args),
+                                   to_refresh):
+            if member is None:
+                counts['failed'] += 1
+            else:
+                member['next_sync_at'] = first_sync_at + timedelta(
+                    seconds=len(members) * stagger)
+                members.append(member)
+        if not members:
+            return counts
+
+        counts['imported'] = self.create_members(members)
+        counts['failed'] += len(members) - counts['imported']
+        return counts
+
+    def lookup_runkeeper_id(self, row):
+        """
+        Return the RunKeeper ID of a row's member, or None if the lookup of
+        their profile failed.
+        """
+        oh_id, runkeeper_access_token = row[0], row[2]
+        try:
+            user_data = self.runkeeper_client.get_user(
+                runkeeper_access_token)
+            return str(user_data['userID'])
+        except Exception as e:
+            logger.warning('RunKeeper profile lookup for {} failed: '
+                           '{!r}'.format(oh_id, e))
+            return None
+
+    @staticmethod
+    def refresh_member(row, runkeeper_id):
+        """
+        Refresh a member's Open Humans token. Returns the data to create the
+        member with, or None.
+        """
+        oh_id, oh_refresh_token, runkeeper_access_token = row[:3]
+        try:
+            token_data = OpenHumansMember.request_token_refresh(
+                oh_refresh_token,
+                client_id=settings.OPENHUMANS_CLIENT_ID,
+                client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+        except Exception as e:
+            logger.warning('Token refresh for {} failed: {!r}'.format(
+                oh_id, e))
+            return None
+        if token_data is None:
+            logger.warning('Token refresh refused for {}'.format(oh_id))
+            return None
+        return {'oh_id': oh_id, 'token_data': token_data,
+                'runkeeper_id': runkeeper_id,
+                'runkeeper_access_token': runkeeper_access_token}
+
+    def create_members(self, members):
+        """
+        Create the users and members of a batch with a few bulk inserts.
+
+        If that fails (e.g. because another process created one of them in
+        the meantime), they're created one by one instead, so that one bad
+        member doesn't keep out the others, whose tokens were refreshed
+        already. Returns the number of members created.
+        """
+        try:
+            with transaction.atomic():
+                self.insert_members(members)
+            return len(members)
+        except IntegrityError as e:
+            logger.warning('Bulk import failed, importing members one by '
+                           'one: {!r}'.format(e))
+        created = 0
+        for member in members:
+            try:
+                with transaction.atomic():
+                    self.insert_members([member])
+            except IntegrityError as e:
+                logger.error('Import of {} failed: {!r}'.format(
+                    member['oh_id'], e))
+                continue
+            created += 1
+        return created
+
+    @staticmethod
+    def insert_members(members):
+        base_names = {m['oh_id']: '{}_openhumans'.format(m['oh_id'])
+                      for m in members}
+        unique_names = make_unique_usernames(base_names.values())
+        usernames = {oh_id: unique_names[name]
+                     for oh_id, name in base_names.items()}
+        User.objects.bulk_create(
+            [User(username=name) for name in usernames.values()])
+        # Not every database returns the primary keys of bulk inserts.
+        user_ids = dict(User.objects.filter(
+            username__in=usernames.values()).values_list('username', 'id'))
+        OpenHumansMember.objects.bulk_create([OpenHumansMember(
+            user_id=user_ids[usernames[m['oh_id']]],
+            oh_id=m['oh_id'],
+            access_token=m['token_data']['access_token'],
+            refresh_token=m['token_data']['refresh_token'],
+            token_expires=OpenHumansMember.get_expiration(
+                m['token_data']['expires_in']))
+            for m in members])
+        DataSourceMember.objects.bulk_create([DataSourceMember(
+            user_id=m['oh_id'],
+            runkeeper_id=m['runkeeper_id'],
+            access_token=m['runkeeper_access_token'],
+            next_sync_at=m['next_sync_at'])
+            for m in members])
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from main.models import DataSourceMember
 from datauploader.tasks import process_runkeeper
+from celery import group
 import arrow
 from datetime import timedelta
 
@@ -8,11 +9,47 @@ from datetime import timedelta
 class Command(BaseCommand):
     help = 'Updates data for all members'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=4,
+                            help='Update members not updated for this long')
+        parser.add_argument('--limit', type=int,
+                            help='Update at most this many members, '
+                                 'least recently updated first')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Members fetched and queued at once')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the members to update')
+
     def handle(self, *args, **options):
-        users = DataSourceMember.objects.all()
-        for runkeeper_user in users:
-            if runkeeper_user.last_updated < (arrow.now() - timedelta(days=4)):
-                oh_id = runkeeper_user.user.oh_id
-                process_runkeeper.delay(oh_id)
-            else:
-                print("didn't update {}".format(runkeeper_user.runkeeper_id))
+        stale = DataSourceMember.objects.filter(
+            last_updated__lt=(arrow.now() - timedelta(
+                days=options['days'])).datetime).order_by('last_updated')
+        if options['limit'] is not None:
+            stale = stale[:options['limit']]
+
+        if options['dry_run']:
+            print('would update {} members'.format(stale.count()))
+            return
+
+        # Only the Open Humans IDs are needed, fetched in one query with the
+        # join and streamed in chunks rather than loaded all at once.
+        oh_ids = stale.values_list('user__oh_id', flat=True).iterator(
+            chunk_size=options['batch_size'])
+        queued = 0
+        batch = []
+        for oh_id in oh_ids:
+            batch.append(oh_id)
+            if len(batch) >= options['batch_size']:
+                queued += self.enqueue(batch)
+                batch = []
+        if batch:
+            queued += self.enqueue(batch)
+        print('queued updates for {} members'.format(queued))
+
+    @staticmethod
+    def enqueue(oh_ids):
+        """
+        Send process_runkeeper tasks for oh_ids over one broker connection.
+        """
+        group(process_runkeeper.si(oh_id) for oh_id in oh_ids).apply_async()
+        return len(oh_ids)
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.3 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_auto_20180430_1734'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcemember',
+            name='sync_watermark',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.1.3 on 2026-10-18 13:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_datasourcemember_sync_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('basename', models.CharField(max_length=128)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('uploaded_at', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_files', to='main.DataSourceMember')),
+            ],
+            options={
+                'unique_together': {('member', 'year')},
+            },
+        ),
+    ]
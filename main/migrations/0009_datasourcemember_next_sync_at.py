@@ -0,0 +1,42 @@
+# Generated by Django 2.1.3 on 2026-10-18 13:33
+
+from datetime import timedelta
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def schedule_existing_members(apps, schema_editor):
+    # Existing members are due four days after their last update, as they
+    # were with the update_data command.
+    DataSourceMember = apps.get_model('main', 'DataSourceMember')
+    DataSourceMember.objects.update(
+        next_sync_at=F('last_updated') + timedelta(days=4))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_datafile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcemember',
+            name='next_sync_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='datasourcemember',
+            name='last_submitted',
+            field=models.DateTimeField(db_index=True, default='2026-10-11 13:33:02+00:00'),
+        ),
+        migrations.AlterField(
+            model_name='datasourcemember',
+            name='last_updated',
+            field=models.DateTimeField(db_index=True, default='2026-10-11 13:33:02+00:00'),
+        ),
+        migrations.RunPython(schedule_existing_members,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.3 on 2026-10-18 13:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_datasourcemember_next_sync_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('plan', models.TextField()),
+                ('fetched_uris', models.TextField(default='[]')),
+                ('uploaded_years', models.TextField(default='[]')),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('member', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoint', to='main.DataSourceMember')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.3 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafile',
+            name='feed_hash',
+            field=models.CharField(default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.1.3 on 2026-10-18 18:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_datafile_feed_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synccheckpoint',
+            name='attempt',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='synccheckpoint',
+            name='heartbeat_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.3 on 2026-10-18 19:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_synccheckpoint_attempt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FetchedActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uri', models.CharField(max_length=255)),
+                ('data', models.BinaryField()),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fetched_activities', to='main.SyncCheckpoint')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='fetchedactivity',
+            unique_together={('checkpoint', 'uri')},
+        ),
+    ]
@@ -1,11 +1,31 @@
-from django.db import models
+import json
+import uuid
+import zlib
+
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
+from django.utils import timezone
 from open_humans.models import OpenHumansMember
 import requests
 from datetime import timedelta
 import arrow
 
 
+class DataSourceMemberQuerySet(models.QuerySet):
+
+    def due_for_sync(self, now=None, limit=None):
+        """
+        Return members whose next sync is due, the longest overdue first.
+
+        Served by the index on next_sync_at, without scanning the table.
+        """
+        members = self.filter(
+            next_sync_at__lte=now or timezone.now()).order_by('next_sync_at')
+        if limit is not None:
+            members = members[:limit]
+        return members
+
+
 class DataSourceMember(models.Model):
     """
     Store OAuth data for a data source.
@@ -24,6 +44,219 @@ class DataSourceMember(models.Model):
                                     default='')
     access_token = models.CharField(max_length=256, default="")
     last_updated = models.DateTimeField(
-                            default=(arrow.now() - timedelta(days=7)).format())
+                            default=(arrow.now() - timedelta(days=7)).format(),
+                            db_index=True)
     last_submitted = models.DateTimeField(
-                            default=(arrow.now() - timedelta(days=7)).format())
+                            default=(arrow.now() - timedelta(days=7)).format(),
+                            db_index=True)
+    # Start time of the latest activity seen in the last sync. Years before
+    # the one this falls in are not processed again by incremental syncs.
+    sync_watermark = models.DateTimeField(null=True, blank=True)
+    # When the member is due for their next sync, see due_for_sync. New
+    # members are due right away. Each sync pushes it back by
+    # RUNKEEPER_SYNC_RETRY_DELAY when it starts, and schedules the next one
+    # RUNKEEPER_SYNC_INTERVAL later when it finishes.
+    next_sync_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = DataSourceMemberQuerySet.as_manager()
+
+    def schedule_next_sync(self, now=None):
+        self.next_sync_at = (now or timezone.now()) + timedelta(
+            seconds=settings.RUNKEEPER_SYNC_INTERVAL)
+
+
+class DataFile(models.Model):
+    """
+    A yearly data file uploaded to Open Humans for a DataSourceMember.
+
+    content_hash covers both the file and its metadata, so files that haven't
+    changed since their last upload can be skipped. feed_hash covers the
+    year's items in the RunKeeper feeds at that upload, and whether the year
+    was over, so that years before the sync_watermark are only processed
+    again if activities were added to or removed from them since, or to
+    mark them complete.
+    """
+    member = models.ForeignKey(DataSourceMember, related_name='data_files',
+                               on_delete=models.CASCADE)
+    year = models.IntegerField()
+    basename = models.CharField(max_length=128)
+    content_hash = models.CharField(max_length=64)
+    feed_hash = models.CharField(max_length=64, default='')
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('member', 'year')
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Progress of a DataSourceMember's sync, so that a retried sync resumes
+    where the previous attempt stopped.
+
+    plan holds the years to upload as planned by process_runkeeper (JSON),
+    fetched_uris the activities fetched so far and uploaded_years the years
+    uploaded so far (JSON lists). The data of the fetched activities is kept
+    in FetchedActivity rows until the upload. The checkpoint is deleted, with
+    those, once the sync is finished.
+
+    attempt identifies the attempt running the sync (see claim), whose tasks
+    only record progress while it still does. heartbeat_at is when it last
+    showed it's alive; an attempt whose tasks haven't done so for
+    RUNKEEPER_SYNC_STALE_AFTER seconds is taken to have died.
+    """
+    member = models.OneToOneField(DataSourceMember,
+                                  related_name='sync_checkpoint',
+                                  on_delete=models.CASCADE)
+    plan = models.TextField()
+    fetched_uris = models.TextField(default='[]')
+    uploaded_years = models.TextField(default='[]')
+    started_at = models.DateTimeField(auto_now_add=True)
+    attempt = models.CharField(max_length=32, default='')
+    heartbeat_at = models.DateTimeField(default=timezone.now)
+
+    def get_plan(self):
+        return json.loads(self.plan)
+
+    def get_fetched_uris(self):
+        return set(json.loads(self.fetched_uris))
+
+    def get_uploaded_years(self):
+        return set(json.loads(self.uploaded_years))
+
+    def is_alive(self, now=None):
+        return self.heartbeat_at > (now or timezone.now()) - timedelta(
+            seconds=settings.RUNKEEPER_SYNC_STALE_AFTER)
+
+    @classmethod
+    def claim(cls, member, full_sync=False):
+        """
+        Start a new attempt at the member's sync, and return its checkpoint.
+
+        Returns None if an attempt that's alive is running the sync already.
+        The checkpoint of one that died is taken over, so that the new
+        attempt resumes from it, unless it's older than
+        RUNKEEPER_CHECKPOINT_MAX_AGE, wasn't planned yet, or is of an
+        incremental sync while a full one is asked for. A new checkpoint, with
+        an empty plan, replaces it then.
+        """
+        now = timezone.now()
+        attempt = uuid.uuid4().hex
+        with transaction.atomic():
+            checkpoint = cls.objects.select_for_update().filter(
+                member=member).first()
+            if checkpoint is not None:
+                if checkpoint.is_alive(now):
+                    return None
+                max_age = timedelta(
+                    seconds=settings.RUNKEEPER_CHECKPOINT_MAX_AGE)
+                incremental = (checkpoint.plan and
+                               not checkpoint.get_plan()['full_sync'])
+                if (checkpoint.started_at < now - max_age or
+                        not checkpoint.plan or (full_sync and incremental)):
+                    checkpoint.delete()
+                    checkpoint = None
+            if checkpoint is None:
+                try:
+                    with transaction.atomic():
+                        return cls.objects.create(
+                            member=member, plan='', attempt=attempt,
+                            heartbeat_at=now)
+                except IntegrityError:
+                    # Claimed by a sync started at the same time.
+                    return None
+            checkpoint.attempt = attempt
+            checkpoint.heartbeat_at = now
+            checkpoint.save(update_fields=['attempt', 'heartbeat_at'])
+            return checkpoint
+
+    @classmethod
+    def beat(cls, member, attempt, **fields):
+        """
+        Record that attempt is alive, along with any fields given. Returns
+        False if it doesn't run the member's sync anymore.
+        """
+        return cls.objects.filter(member=member, attempt=attempt).update(
+            heartbeat_at=timezone.now(), **fields) > 0
+
+    @classmethod
+    def finish(cls, member, attempt):
+        """
+        Delete the checkpoint of attempt. Returns False if it doesn't run the
+        member's sync anymore.
+        """
+        return cls.objects.filter(member=member,
+                                  attempt=attempt).delete()[0] > 0
+
+    def get_fetched_activities(self, uris):
+        """
+        Return the data of the fetched activities among uris, by URI.
+        """
+        return {uri: FetchedActivity.decode(data)
+                for uri, data in self.fetched_activities.filter(
+                    uri__in=uris).values_list('uri', 'data')}
+
+    @classmethod
+    def add_fetched_activities(cls, member, attempt, activities):
+        """
+        Store fetched activities (their data by URI) for the upload step, and
+        record them as fetched.
+        """
+        def store(checkpoint):
+            # Stored already if a retried task got this far before.
+            checkpoint.fetched_activities.filter(
+                uri__in=list(activities)).delete()
+            FetchedActivity.objects.bulk_create([
+                FetchedActivity(checkpoint=checkpoint, uri=uri,
+                                data=FetchedActivity.encode(data))
+                for uri, data in activities.items()])
+        return cls._add(member, attempt, 'fetched_uris', list(activities),
+                        store)
+
+    @classmethod
+    def add_uploaded_year(cls, member, attempt, year):
+        return cls._add(member, attempt, 'uploaded_years', [year])
+
+    @classmethod
+    def _add(cls, member, attempt, field, values, store=None):
+        # Tasks of the same sync record their progress concurrently, so the
+        # row is locked while its list is extended.
+        with transaction.atomic():
+            checkpoint = cls.objects.select_for_update().filter(
+                member=member, attempt=attempt).first()
+            if checkpoint is None:
+                return False
+            if store is not None:
+                store(checkpoint)
+            merged = set(json.loads(getattr(checkpoint, field)))
+            merged.update(values)
+            setattr(checkpoint, field, json.dumps(sorted(merged)))
+            checkpoint.heartbeat_at = timezone.now()
+            checkpoint.save(update_fields=[field, 'heartbeat_at'])
+        return True
+
+
+class FetchedActivity(models.Model):
+    """
+    The data of a fitness activity fetched for a sync, which the upload step
+    reads it from. data is zlib-compressed JSON, as GPS paths make it large.
+
+    Unlike the activity cache, this holds all activities of the syncs in
+    progress, however many there are.
+    """
+    checkpoint = models.ForeignKey(SyncCheckpoint,
+                                   related_name='fetched_activities',
+                                   on_delete=models.CASCADE)
+    uri = models.CharField(max_length=255)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ('checkpoint', 'uri')
+
+    @staticmethod
+    def encode(data):
+        return zlib.compress(
+            json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def decode(data):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
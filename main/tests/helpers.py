@@ -0,0 +1,28 @@
+from unittest import mock
+from requests_respectful import RespectfulRequester
+from datauploader import runkeeper, tasks
+
+TEST_REALM = 'test-runkeeper'
+TEST_CACHE_PREFIX = 'TestRunkeeperActivityCache'
+
+
+class IsolatedRunkeeperMixin:
+    """
+    Send RunKeeper calls through a test realm, and cache activities under a
+    test prefix, so that tests neither wait for the permits of the app's
+    realm nor share its cache. Both are cleared after each test.
+    """
+
+    def setUp(self):
+        super().setUp()
+        rr = RespectfulRequester()
+        rr.register_realm(TEST_REALM, max_requests=1000, timespan=60)
+        self.addCleanup(rr.unregister_realm, TEST_REALM)
+        for patch in [
+                mock.patch.object(runkeeper.RunkeeperClient, 'realm',
+                                  TEST_REALM),
+                mock.patch.object(tasks.activity_cache, 'redis_prefix',
+                                  TEST_CACHE_PREFIX)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(tasks.activity_cache.clear)
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+from datauploader.cache import ActivityCache
+from .helpers import TEST_CACHE_PREFIX
+
+
+class ActivityCacheTestCase(SimpleTestCase):
+    """
+    test that activity data is cached per feed item
+    """
+
+    def setUp(self):
+        self.cache = ActivityCache.from_url(
+            settings.RUNKEEPER_CACHE_REDIS_URL, max_bytes=100000)
+        self.cache.redis_prefix = TEST_CACHE_PREFIX
+        self.item = {'uri': '/fitnessActivities/1', 'duration': 100}
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def limit_to_two_entries(self):
+        # Entries like the ones below.
+        self.cache.max_bytes = 2 * len(ActivityCache._encode('f', 1))
+
+    def total_bytes(self):
+        return int(self.cache.redis.get(self.cache._total_key))
+
+    def test_changed_feed_item_invalidates(self):
+        fingerprint = ActivityCache.fingerprint(self.item)
+        self.cache.set(self.item['uri'], fingerprint, {'type': 'Running'})
+        self.assertEqual(self.cache.get(self.item['uri'], fingerprint),
+                         {'type': 'Running'})
+        self.item['duration'] = 200
+        self.assertIsNone(self.cache.get(self.item['uri'],
+                                         ActivityCache.fingerprint(self.item)))
+
+    def test_entries_compressed(self):
+        path = [{'latitude': 52.1, 'longitude': 4.3}] * 1000
+        self.cache.set(self.item['uri'], 'f', {'path': path})
+        raw_entry = self.cache.redis.get(
+            self.cache._entry_key(self.item['uri']))
+        self.assertLess(len(raw_entry), len(str(path)) / 10)
+        self.assertEqual(self.cache.get(self.item['uri'], 'f'),
+                         {'path': path})
+
+    def test_least_recently_used_is_evicted(self):
+        self.limit_to_two_entries()
+        for i in range(1, 3):
+            self.cache.set('/fitnessActivities/{}'.format(i), 'f', i)
+        self.cache.get('/fitnessActivities/1', 'f')
+        self.cache.set('/fitnessActivities/3', 'f', 3)
+        self.assertEqual(self.cache.get('/fitnessActivities/1', 'f'), 1)
+        self.assertIsNone(self.cache.get('/fitnessActivities/2', 'f'))
+        self.assertEqual(self.cache.get('/fitnessActivities/3', 'f'), 3)
+        self.assertEqual(self.total_bytes(), self.cache.max_bytes)
+
+    def test_size_tracked(self):
+        self.limit_to_two_entries()
+        self.cache.set('/fitnessActivities/1', 'f', 1)
+        self.cache.set('/fitnessActivities/1', 'f', 2)
+        self.assertEqual(self.total_bytes(), self.cache.max_bytes // 2)
+        self.cache.delete('/fitnessActivities/1')
+        self.assertEqual(self.total_bytes(), 0)
+
+    def test_unavailable_redis_is_a_miss(self):
+        # Nothing listens on port 1.
+        cache = ActivityCache.from_url('redis://localhost:1/2',
+                                       max_bytes=100000)
+        with self.assertLogs('datauploader.cache', 'WARNING') as logs:
+            cache.set(self.item['uri'], 'f', {'type': 'Running'})
+            self.assertIsNone(cache.get(self.item['uri'], 'f'))
+        self.assertEqual(len(logs.output), 2)
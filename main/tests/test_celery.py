@@ -1,23 +1,31 @@
-from datauploader.tasks import process_runkeeper
+from unittest import mock
+from datauploader.celery import app
+from datauploader.tasks import (fetch_runkeeper_activities,
+                                process_runkeeper, upload_runkeeper_years)
 from django.test import TestCase
 from freezegun import freeze_time
 from django.conf import settings
 import vcr
 from open_humans.models import OpenHumansMember
-from main.models import DataSourceMember
+from main.models import DataSourceMember, SyncCheckpoint
+import json
 import arrow
+import requests
+from .helpers import IsolatedRunkeeperMixin
 
 
-class CeleryTestCase(TestCase):
+class CeleryTestCase(IsolatedRunkeeperMixin, TestCase):
     """
     test that celery processing works
     """
 
     def setUp(self):
+        super().setUp()
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
         settings.RUNKEEPER_CLIENT_ID = 'RUNKEEPER_CLIENT_ID'
         settings.RUNKEEPER_CLIENT_SECRET = 'RUNKEEPER_CLIENT_SECRET'
+        app.conf.update(task_always_eager=True)
         oh_member = OpenHumansMember.create(
                             oh_id=23456789,
                             access_token="new_oh_access_token",
@@ -32,6 +40,9 @@ class CeleryTestCase(TestCase):
         )
         runkeeper_member.user = oh_member
         runkeeper_member.save()
+        # Last progress of a sync that died, at the frozen time below.
+        self.stale = arrow.get('2016-06-24').shift(
+            seconds=-settings.RUNKEEPER_SYNC_STALE_AFTER - 1).datetime
 
     @freeze_time('2016-06-24')
     @vcr.use_cassette('main/tests/fixtures/import_users.yaml',
@@ -41,3 +52,149 @@ class CeleryTestCase(TestCase):
         process_runkeeper(oh_member.oh_id)
         runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
         self.assertEqual(runkeeper_member.last_updated, arrow.get('2016-06-24'))
+
+    @freeze_time('2016-06-24')
+    def test_incremental_update_skips_old_years(self):
+        oh_id = OpenHumansMember.objects.get(oh_id=23456789).oh_id
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none'):
+            process_runkeeper(oh_id)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        runkeeper_member.sync_watermark = arrow.get('2019-01-01').datetime
+        runkeeper_member.save()
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            process_runkeeper(oh_id)
+            # Only /user and the two activity feeds were requested.
+            self.assertEqual(cassette.play_count, 3)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        self.assertEqual(runkeeper_member.sync_watermark,
+                         arrow.get('2018-05-01 09:43:09').datetime)
+
+    @freeze_time('2016-06-24')
+    def test_incremental_update_rebuilds_changed_old_years(self):
+        oh_id = OpenHumansMember.objects.get(oh_id=23456789).oh_id
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none'):
+            process_runkeeper(oh_id)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        feed_hash = runkeeper_member.data_files.get(year=2018).feed_hash
+        self.assertTrue(feed_hash)
+        runkeeper_member.sync_watermark = arrow.get('2019-01-01').datetime
+        runkeeper_member.save()
+        # As if an activity was entered for 2018 after the last sync.
+        runkeeper_member.data_files.update(feed_hash='outdated')
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none'):
+            process_runkeeper(oh_id)
+        self.assertEqual(
+            runkeeper_member.data_files.get(year=2018).feed_hash, feed_hash)
+
+    @freeze_time('2016-06-24')
+    def test_unchanged_files_not_uploaded(self):
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none'):
+            process_runkeeper(oh_member.oh_id)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        self.assertEqual(
+            list(runkeeper_member.data_files.values_list('year', flat=True)),
+            [2018])
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            process_runkeeper(oh_member.oh_id)
+            # The activity comes from the cache and nothing is uploaded.
+            self.assertEqual(cassette.play_count, 3)
+
+    @freeze_time('2016-06-24')
+    def test_sync_resumes_from_checkpoint(self):
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        plan = {'years': [{'year': 2018, 'complete': True,
+                           'background_items': [], 'fitness_items': []}],
+                'new_watermark': '2018-05-01T09:43:09+00:00',
+                'full_sync': False}
+        # Left by an attempt that died.
+        SyncCheckpoint.objects.create(member=runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      heartbeat_at=self.stale)
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            process_runkeeper(runkeeper_member.user.oh_id)
+            played = [cassette.data[i][0].uri for i in cassette.play_counts]
+        # The feeds weren't walked again, but the year was uploaded.
+        self.assertFalse(any('runkeeper.com' in uri for uri in played))
+        self.assertTrue(any('upload/complete' in uri for uri in played))
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        self.assertEqual(runkeeper_member.sync_watermark,
+                         arrow.get('2018-05-01 09:43:09').datetime)
+        self.assertFalse(SyncCheckpoint.objects.exists())
+
+    @freeze_time('2016-06-24')
+    def test_uploaded_years_not_uploaded_again(self):
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        plan = {'years': [{'year': 2018, 'complete': True,
+                           'background_items': [], 'fitness_items': []}],
+                'new_watermark': None, 'full_sync': False}
+        SyncCheckpoint.objects.create(member=runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      uploaded_years='[2018]',
+                                      heartbeat_at=self.stale)
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            process_runkeeper(runkeeper_member.user.oh_id)
+            self.assertEqual(cassette.play_count, 0)
+        self.assertFalse(SyncCheckpoint.objects.exists())
+
+    @freeze_time('2016-06-24')
+    def test_sync_in_progress_not_started_again(self):
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        plan = {'years': [{'year': 2018, 'complete': True,
+                           'background_items': [], 'fitness_items': []}],
+                'new_watermark': None, 'full_sync': False}
+        SyncCheckpoint.objects.create(member=runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      attempt='running')
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            process_runkeeper(runkeeper_member.user.oh_id)
+            self.assertEqual(cassette.play_count, 0)
+        self.assertEqual(SyncCheckpoint.objects.get().attempt, 'running')
+
+    @freeze_time('2016-06-24')
+    def test_tasks_of_taken_over_sync_stop(self):
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        item = {'uri': '/fitnessActivities/1'}
+        plan = {'years': [{'year': 2018, 'complete': True,
+                           'background_items': [], 'fitness_items': [item]}],
+                'new_watermark': None, 'full_sync': False}
+        SyncCheckpoint.objects.create(member=runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      attempt='old', heartbeat_at=self.stale)
+        self.assertIsNotNone(SyncCheckpoint.claim(runkeeper_member))
+        oh_id = runkeeper_member.user.oh_id
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            self.assertEqual(
+                fetch_runkeeper_activities(oh_id, 'old', [item]), 0)
+            upload_runkeeper_years(oh_id, 'old')
+            self.assertEqual(cassette.play_count, 0)
+        checkpoint = SyncCheckpoint.objects.get()
+        self.assertNotEqual(checkpoint.attempt, 'old')
+        self.assertEqual(checkpoint.get_fetched_uris(), set())
+
+    @freeze_time('2016-06-24')
+    @mock.patch('datauploader.tasks.plan_sync',
+                side_effect=requests.ConnectionError)
+    def test_sync_pushes_back_scheduled_sync(self, plan_sync):
+        oh_id = OpenHumansMember.objects.get(oh_id=23456789).oh_id
+        # Started from the dashboard, like right after connecting.
+        with self.assertRaises(requests.ConnectionError):
+            process_runkeeper(oh_id, interactive=True)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        self.assertEqual(
+            runkeeper_member.next_sync_at,
+            arrow.get('2016-06-24').shift(
+                seconds=settings.RUNKEEPER_SYNC_RETRY_DELAY).datetime)
+        self.assertFalse(DataSourceMember.objects.due_for_sync().exists())
+        # The failed attempt left nothing in the way of the retry.
+        self.assertFalse(SyncCheckpoint.objects.exists())
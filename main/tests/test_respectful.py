@@ -0,0 +1,249 @@
+import inspect
+import time
+from unittest import mock
+from django.test import SimpleTestCase
+import requests
+from requests_respectful import (RequestsRespectfulError,
+                                 RequestsRespectfulRateLimitedError,
+                                 RespectfulRequester)
+from requests_respectful.respectful_requester import REALM_CACHE_TTL
+from .helpers import TEST_REALM
+
+OTHER_TEST_REALM = 'test-other'
+UNREGISTERED_TEST_REALM = 'test-unregistered'
+
+
+class RealmTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.rr = RespectfulRequester()
+        self.safety_threshold = self.rr._config()['safety_threshold']
+        # Three requests per minute, once the safety threshold is taken off.
+        self.rr.register_realm(TEST_REALM, timespan=60,
+                               max_requests=self.safety_threshold + 3)
+        self.rr.register_realm(OTHER_TEST_REALM, timespan=60,
+                               max_requests=self.safety_threshold + 1)
+
+    def tearDown(self):
+        self.rr.unregister_realms([TEST_REALM, OTHER_TEST_REALM])
+
+    def requests_in(self, realm):
+        return self.rr.redis.zcard(self.rr._realm_requests_redis_key(realm))
+
+    def age_requests(self, realm, seconds):
+        # As if the requests were made that much earlier.
+        key = self.rr._realm_requests_redis_key(realm)
+        for request_id, score in self.rr.redis.zrange(key, 0, -1,
+                                                      withscores=True):
+            self.rr.redis.execute_command('ZADD', key, score - seconds * 1000,
+                                          request_id)
+
+
+class SlidingWindowTestCase(RealmTestCase):
+    """
+    test that realms allow their limit of requests per timespan
+    """
+
+    def test_limit_minus_safety_threshold(self):
+        for _ in range(3):
+            rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+            self.assertEqual(rate_limited, [])
+        rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+        self.assertEqual(rate_limited, [TEST_REALM])
+        self.assertEqual(self.requests_in(TEST_REALM), 3)
+
+    def test_old_requests_expire(self):
+        for _ in range(3):
+            self.rr._acquire_permit([TEST_REALM])
+        self.age_requests(TEST_REALM, 59)
+        rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+        self.assertEqual(rate_limited, [TEST_REALM])
+        self.age_requests(TEST_REALM, 2)
+        rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+        self.assertEqual(rate_limited, [])
+        self.assertEqual(self.requests_in(TEST_REALM), 1)
+
+    def test_realms_recorded_together(self):
+        realms = [TEST_REALM, OTHER_TEST_REALM]
+        rate_limited, _ = self.rr._acquire_permit(realms)
+        self.assertEqual(rate_limited, [])
+        rate_limited, _ = self.rr._acquire_permit(realms)
+        self.assertEqual(rate_limited, [OTHER_TEST_REALM])
+        # The request that wasn't allowed isn't recorded in either realm.
+        self.assertEqual(self.requests_in(TEST_REALM), 1)
+        self.assertEqual(self.requests_in(OTHER_TEST_REALM), 1)
+
+    def test_unregister_realm_clears_keys(self):
+        self.rr._acquire_permit([OTHER_TEST_REALM])
+        # Waiting, with a flow, in a realm that's full and throttled.
+        self.rr._acquire_permit([OTHER_TEST_REALM], waiter_id='waiter',
+                                flow='member')
+        self.rr.throttled([OTHER_TEST_REALM])
+        keys = [self.rr._realm_redis_key(OTHER_TEST_REALM),
+                self.rr._realm_requests_redis_key(OTHER_TEST_REALM),
+                self.rr._realm_waiters_redis_key(OTHER_TEST_REALM),
+                self.rr._realm_heartbeats_redis_key(OTHER_TEST_REALM),
+                self.rr._realm_adaptive_redis_key(OTHER_TEST_REALM),
+                self.rr._realm_fairness_redis_key(OTHER_TEST_REALM)]
+        self.assertTrue(all(self.rr.redis.exists(key) for key in keys))
+        self.rr.unregister_realm(OTHER_TEST_REALM)
+        self.assertFalse(any(self.rr.redis.exists(key) for key in keys))
+        self.assertNotIn(OTHER_TEST_REALM, self.rr.fetch_registered_realms())
+
+
+class AcquireTestCase(RealmTestCase):
+    """
+    test that waiters are told how long to wait and served in order
+    """
+
+    def fill(self, count=3):
+        for _ in range(count):
+            rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+            self.assertEqual(rate_limited, [])
+
+    def waiters_in(self, realm):
+        return (
+            self.rr.redis.zcard(self.rr._realm_waiters_redis_key(realm)),
+            self.rr.redis.zcard(self.rr._realm_heartbeats_redis_key(realm)))
+
+    def test_wait_until_request_expires(self):
+        self.fill()
+        self.age_requests(TEST_REALM, 20)
+        rate_limited, wait = self.rr._acquire_permit([TEST_REALM])
+        self.assertEqual(rate_limited, [TEST_REALM])
+        self.assertAlmostEqual(wait, 40, delta=1)
+
+    def test_waiters_served_in_order(self):
+        self.fill(1)
+        self.age_requests(TEST_REALM, 30)
+        self.fill(2)
+        first, second = (self.rr._new_waiter_id(),
+                         self.rr._new_waiter_id())
+        for waiter_id in [first, second]:
+            rate_limited, _ = self.rr._acquire_permit(
+                [TEST_REALM], waiter_id=waiter_id)
+            self.assertEqual(rate_limited, [TEST_REALM])
+        # One request expires, which frees a permit for the first waiter.
+        self.age_requests(TEST_REALM, 31)
+        rate_limited, wait = self.rr._acquire_permit([TEST_REALM],
+                                                     waiter_id=second)
+        self.assertEqual(rate_limited, [TEST_REALM])
+        # The second waiter's turn comes when the next request expires.
+        self.assertAlmostEqual(wait, 29, delta=1)
+        rate_limited, _ = self.rr._acquire_permit([TEST_REALM],
+                                                  waiter_id=first)
+        self.assertEqual(rate_limited, [])
+        self.assertEqual(self.waiters_in(TEST_REALM), (1, 1))
+
+    def test_timeout(self):
+        self.fill()
+        start = time.time()
+        with self.assertRaises(RequestsRespectfulRateLimitedError):
+            self.rr.acquire([TEST_REALM], timeout=5)
+        # The wait is known to exceed the timeout, so it gives up at once.
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.waiters_in(TEST_REALM), (0, 0))
+
+    def test_acquire_waits_for_permit(self):
+        self.fill()
+        self.age_requests(TEST_REALM, 59.8)
+        start = time.time()
+        self.assertTrue(self.rr.acquire([TEST_REALM], timeout=5))
+        self.assertGreater(time.time() - start, 0.1)
+        self.assertEqual(self.waiters_in(TEST_REALM), (0, 0))
+
+
+class AdaptiveLimitTestCase(RealmTestCase):
+    """
+    test that a throttled realm's limit recovers as requests succeed
+    """
+
+    def adaptive(self):
+        key = self.rr._realm_adaptive_redis_key(TEST_REALM)
+        limit = self.rr.redis.hget(key, 'limit')
+        return (None if limit is None else float(limit),
+                self.rr.redis.pttl(key))
+
+    def test_limit_recovers(self):
+        self.rr.throttled([TEST_REALM], retry_after=0)
+        self.assertEqual(self.adaptive()[0], 1)
+        limits = []
+        for _ in range(4):
+            # As if a timespan passed, and almost ten since the throttling.
+            self.age_requests(TEST_REALM, 60)
+            self.rr.redis.pexpire(
+                self.rr._realm_adaptive_redis_key(TEST_REALM), 100)
+            rate_limited, _ = self.rr._acquire_permit([TEST_REALM])
+            self.assertEqual(rate_limited, [])
+            limit, ttl = self.adaptive()
+            limits.append(limit if limit is None else round(limit, 6))
+            if limit is not None:
+                # Kept for another ten timespans.
+                self.assertGreater(ttl, 9 * 60 * 1000)
+        # Raised by 1 / limit per request, then back at the limit of 3.
+        self.assertEqual(limits, [2, 2.5, 2.9, None])
+
+
+class RealmCacheTestCase(RealmTestCase):
+    """
+    test that realm configurations and request validations are cached
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.rr.unregister_realm, UNREGISTERED_TEST_REALM)
+
+    def fetches(self):
+        return mock.patch.object(self.rr, '_fetch_realm_info',
+                                 wraps=self.rr._fetch_realm_info)
+
+    def later(self, seconds):
+        clock = mock.Mock()
+        clock.time.return_value = time.time() + seconds
+        return mock.patch('requests_respectful.respectful_requester.time',
+                          clock)
+
+    def test_config_cached_until_ttl(self):
+        config = (self.safety_threshold + 3, 60)
+        self.assertEqual(self.rr._realm_config(TEST_REALM), config)
+        # Changed in Redis, as if by another process.
+        self.rr.redis.hset(self.rr._realm_redis_key(TEST_REALM),
+                           'max_requests', 100)
+        with self.fetches() as fetch_realm_info:
+            self.assertEqual(self.rr._realm_config(TEST_REALM), config)
+            self.assertEqual(self.rr.realm_timespan(TEST_REALM), 60)
+            self.assertEqual(fetch_realm_info.call_count, 0)
+        with self.later(REALM_CACHE_TTL + 1):
+            self.assertEqual(self.rr._realm_config(TEST_REALM), (100, 60))
+
+    def test_changes_invalidate(self):
+        self.rr._realm_config(TEST_REALM)
+        self.rr.update_realm(TEST_REALM, max_requests=20)
+        self.assertEqual(self.rr._realm_config(TEST_REALM), (20, 60))
+        self.rr.unregister_realm(TEST_REALM)
+        self.assertIsNone(self.rr._realm_config(TEST_REALM))
+        self.rr.register_realm(TEST_REALM, max_requests=30, timespan=10)
+        self.assertEqual(self.rr._realm_config(TEST_REALM), (30, 10))
+
+    def test_unregistered_realm_cached(self):
+        with self.fetches() as fetch_realm_info:
+            for _ in range(2):
+                with self.assertRaises(RequestsRespectfulError):
+                    self.rr._validate_realms([UNREGISTERED_TEST_REALM])
+            self.assertEqual(fetch_realm_info.call_count, 1)
+        self.rr.register_realm(UNREGISTERED_TEST_REALM, max_requests=10,
+                               timespan=60)
+        self.rr._validate_realms([UNREGISTERED_TEST_REALM])
+
+    def test_request_func_inspected_once(self):
+        url = 'https://example.com'
+        with mock.patch('requests_respectful.respectful_requester.inspect.'
+                        'getsource', wraps=inspect.getsource) as getsource:
+            for _ in range(3):
+                self.rr._validate_request_func(lambda: requests.get(url))
+            self.assertEqual(getsource.call_count, 1)
+            # Invalid functions aren't remembered, and fail every time.
+            for _ in range(2):
+                with self.assertRaises(RequestsRespectfulError):
+                    self.rr._validate_request_func(lambda: url.upper())
+            self.assertEqual(getsource.call_count, 3)
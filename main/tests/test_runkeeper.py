@@ -0,0 +1,107 @@
+import json
+from unittest import mock
+import requests
+from django.test import SimpleTestCase
+from requests_respectful import (RequestsRespectfulRateLimitedError,
+                                 RespectfulRequester)
+from datauploader.runkeeper import RunkeeperClient, parse_retry_after
+from .helpers import TEST_REALM
+
+
+def response(status_code, json_data=None, headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp._content = json.dumps(json_data or {}).encode('utf-8')
+    return resp
+
+
+class RunkeeperClientTestCase(SimpleTestCase):
+    """
+    test that throttled requests back off and are retried
+    """
+
+    def setUp(self):
+        self.rr = RespectfulRequester()
+        self.rr.register_realm(TEST_REALM, max_requests=100, timespan=60)
+        self.client = RunkeeperClient(pool_size=1, realm=TEST_REALM)
+
+    def tearDown(self):
+        self.rr.unregister_realm(TEST_REALM)
+
+    def test_retry_after_throttled(self):
+        with mock.patch.object(self.client.session, 'get', side_effect=[
+                response(429, headers={'Retry-After': '0'}),
+                response(200, {'userID': 1})]) as get:
+            self.assertEqual(self.client.get_user('token'), {'userID': 1})
+        self.assertEqual(get.call_count, 2)
+        adaptive = self.rr.redis.hgetall(
+            self.rr._realm_adaptive_redis_key(TEST_REALM))
+        # 100 requests minus the safety threshold, halved and then raised
+        # after the successful retry.
+        limit = (100 - self.rr._config()['safety_threshold']) // 2
+        self.assertAlmostEqual(float(adaptive[b'limit']), limit + 1 / limit)
+
+    def test_gives_up(self):
+        self.client.max_attempts = 2
+        with mock.patch.object(self.client.session, 'get', side_effect=[
+                response(429, headers={'Retry-After': '0'})] * 2):
+            with self.assertRaises(requests.HTTPError):
+                self.client.get_user('token')
+
+    def test_timeout(self):
+        self.rr.throttled([TEST_REALM], retry_after=60)
+        with mock.patch.object(self.client.session, 'get') as get:
+            with self.assertRaises(RequestsRespectfulRateLimitedError):
+                self.client.get_user('token', timeout=0.1)
+        self.assertEqual(get.call_count, 0)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(
+            parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+
+class FairQueuingTestCase(SimpleTestCase):
+    """
+    test that members waiting for the realm are served fairly
+    """
+
+    def setUp(self):
+        self.rr = RespectfulRequester()
+        # No requests allowed at all, so that everyone keeps waiting.
+        self.rr.register_realm(
+            TEST_REALM, timespan=60,
+            max_requests=self.rr._config()['safety_threshold'])
+
+    def tearDown(self):
+        self.rr.unregister_realm(TEST_REALM)
+
+    def queue(self, waiters):
+        for waiter_id, flow, weight in waiters:
+            rate_limited, _ = self.rr._acquire_permit(
+                [TEST_REALM], waiter_id=waiter_id, flow=flow, weight=weight)
+            self.assertEqual(rate_limited, [TEST_REALM])
+        waiters_key = self.rr._realm_waiters_redis_key(TEST_REALM)
+        return [waiter_id.decode('utf-8') for waiter_id in
+                self.rr.redis.zrange(waiters_key, 0, -1)]
+
+    def test_small_flow_not_held_up(self):
+        order = self.queue([('big-1', 'big', 1), ('big-2', 'big', 1),
+                            ('big-3', 'big', 1), ('small-1', 'small', 1)])
+        self.assertEqual(order, ['big-1', 'small-1', 'big-2', 'big-3'])
+
+    def test_arrival_order_without_flows(self):
+        waiter_ids = []
+        for _ in range(5):
+            waiter_ids.append(self.rr._new_waiter_id())
+            self.queue([(waiter_ids[-1], None, 1)])
+        self.assertEqual(self.queue([]), waiter_ids)
+
+    def test_weighted_flow_served_first(self):
+        order = self.queue([('big-1', 'big', 1), ('big-2', 'big', 1),
+                            ('member-1', 'member', 4),
+                            ('member-2', 'member', 4)])
+        self.assertEqual(order[:3], ['member-1', 'member-2', 'big-1'])
@@ -0,0 +1,266 @@
+from datetime import datetime
+import json
+import os
+import time
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from datauploader import tasks, uploads
+from open_humans.models import OpenHumansMember
+from main.models import (DataFile, DataSourceMember, FetchedActivity,
+                         SyncCheckpoint)
+from .helpers import IsolatedRunkeeperMixin
+
+
+FEED_PAGES = {
+    '/feed?page=1': {'size': 5, 'items': [{'n': 3}, {'n': 4}],
+                     'previous': '/feed?page=0', 'next': '/feed?page=2'},
+    '/feed?page=0': {'size': 5, 'items': [{'n': 1}, {'n': 2}]},
+    '/feed?page=2': {'size': 5, 'items': [{'n': 5}]},
+}
+
+
+class IterItemsTestCase(SimpleTestCase):
+    """
+    test that feed pages are walked in order
+    """
+
+    @mock.patch('datauploader.tasks.runkeeper_query',
+                side_effect=lambda path, token, **kwargs: FEED_PAGES[path])
+    def test_pages_in_order(self, runkeeper_query):
+        items = list(tasks.iter_items('/feed?page=1', 'token'))
+        self.assertEqual([item['n'] for item in items], [1, 2, 3, 4, 5])
+        self.assertEqual(runkeeper_query.call_count, 3)
+
+    @mock.patch('datauploader.tasks.runkeeper_query',
+                side_effect=lambda path, token, **kwargs: dict(
+                    FEED_PAGES[path], size=6))
+    def test_size_mismatch(self, runkeeper_query):
+        with self.assertRaises(AssertionError):
+            list(tasks.iter_items('/feed?page=1', 'token'))
+
+
+class FetchInOrderTestCase(SimpleTestCase):
+    """
+    test that concurrent fetches are yielded in order, a bounded few ahead
+    """
+
+    def test_results_in_order(self):
+        # Later items finish first.
+        results = tasks.fetch_in_order(
+            lambda n: time.sleep((5 - n) * 0.01) or n, range(5),
+            max_workers=5)
+        self.assertEqual(list(results), [0, 1, 2, 3, 4])
+
+    def test_bounded_lookahead(self):
+        submitted = []
+
+        def items():
+            for n in range(100):
+                submitted.append(n)
+                yield n
+
+        results = tasks.fetch_in_order(lambda n: n, items(), max_workers=2)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(len(submitted), 4)
+        self.assertEqual(next(results), 1)
+        self.assertEqual(len(submitted), 5)
+        self.assertEqual(list(results), list(range(2, 100)))
+
+
+class ParseRunkeeperTimeTestCase(SimpleTestCase):
+    """
+    test that RunKeeper times are parsed like strptime does
+    """
+
+    def test_matches_strptime(self):
+        for time_string in ['Tue, 1 May 2018 09:43:09',
+                            'Sun, 31 Dec 2017 23:59:59',
+                            'Mon, 01 Jan 2018 00:00:00']:
+            self.assertEqual(
+                tasks.parse_runkeeper_time(time_string),
+                datetime.strptime(time_string, tasks.RUNKEEPER_TIME_FORMAT))
+
+    def test_invalid(self):
+        for time_string in ['Tue, 1 Foo 2018 09:43:09',
+                            'Tue, 31 Apr 2018 09:43:09',
+                            '2018-05-01T09:43:09']:
+            with self.assertRaises(ValueError):
+                tasks.parse_runkeeper_time(time_string)
+
+    def test_yearly_items_sorted(self):
+        items = [{'timestamp': 'Tue, 1 May 2018 09:43:09', 'n': 2},
+                 {'timestamp': 'Sun, 31 Dec 2017 23:59:59', 'n': 1},
+                 {'timestamp': 'Mon, 2 Apr 2018 09:43:09', 'n': 1}]
+        result, _, latest = tasks.yearly_items(items)
+        self.assertEqual([item['n'] for _, item in result[2018]], [1, 2])
+        self.assertEqual(latest, datetime(2018, 5, 1, 9, 43, 9))
+
+
+class YearsToUpdateTestCase(SimpleTestCase):
+    """
+    test which years an incremental sync processes
+    """
+
+    def test_changed_years_before_watermark(self):
+        items = [{'uri': '/fitnessActivities/1'}]
+        uploaded = {2016: tasks.feed_hash([], items, True),
+                    2017: tasks.feed_hash([], items, True)}
+        feed_hashes = {2016: tasks.feed_hash([], items, True),
+                       2017: tasks.feed_hash([], items + items, True),
+                       2018: tasks.feed_hash([], items, False)}
+        self.assertEqual(
+            tasks.years_to_update(feed_hashes, datetime(2018, 3, 1),
+                                  uploaded), [2017, 2018])
+        self.assertEqual(tasks.years_to_update(feed_hashes, None, uploaded),
+                         [2016, 2017, 2018])
+
+    def test_year_uploaded_before_it_was_over(self):
+        # Synced on 1 January, with an activity of that day: the previous
+        # year was uploaded as incomplete, and is processed again once over.
+        items = [{'uri': '/fitnessActivities/1'}]
+        uploaded = {2025: tasks.feed_hash([], items, False)}
+        feed_hashes = {2025: tasks.feed_hash([], items, True),
+                       2026: tasks.feed_hash([], items, False)}
+        self.assertEqual(
+            tasks.years_to_update(feed_hashes, datetime(2026, 1, 1),
+                                  uploaded), [2025, 2026])
+
+
+class UploadTestCase(TestCase):
+    """
+    test that yearly files are uploaded concurrently and recorded
+    """
+
+    def setUp(self):
+        oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="new_oh_access_token",
+                            refresh_token="new_oh_refresh_token",
+                            expires_in=36000)
+        oh_member.save()
+        self.runkeeper_member = DataSourceMember.objects.create(
+            user=oh_member, runkeeper_id=12345678)
+
+    def plan_years(self, years):
+        plan = {'years': [{'year': year, 'complete': True,
+                           'background_items': [], 'fitness_items': []}
+                          for year in years],
+                'new_watermark': None, 'full_sync': False}
+        SyncCheckpoint.objects.create(member=self.runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      attempt='attempt')
+
+    @mock.patch('datauploader.uploads.upload_file')
+    @mock.patch('datauploader.uploads.delete_file')
+    def test_replace_file_deletes_old_basename(self, delete_file,
+                                               upload_file):
+        uploads.replace_file('/tmp/Runkeeper-activity-data-2018.json.gz',
+                             {}, 'token', '23456789',
+                             replaced_basename='Runkeeper-activity-data-'
+                                               '2018.json')
+        self.assertEqual(
+            [c[1]['file_basename'] for c in delete_file.call_args_list],
+            ['Runkeeper-activity-data-2018.json.gz',
+             'Runkeeper-activity-data-2018.json'])
+        self.assertEqual(upload_file.call_count, 1)
+
+    @mock.patch('datauploader.tasks.uploads.replace_file')
+    def test_format_change_replaces_old_file(self, replace_file):
+        DataFile.objects.create(member=self.runkeeper_member, year=2018,
+                                basename='Runkeeper-activity-data-2018.json',
+                                content_hash='old')
+        self.plan_years([2018])
+        with self.settings(RUNKEEPER_OUTPUT_FORMAT='json-gzip'):
+            tasks.upload_runkeeper_years('23456789', 'attempt')
+        args, kwargs = replace_file.call_args
+        self.assertEqual(os.path.basename(args[0]),
+                         'Runkeeper-activity-data-2018.json.gz')
+        self.assertEqual(kwargs['replaced_basename'],
+                         'Runkeeper-activity-data-2018.json')
+        self.assertEqual(self.runkeeper_member.data_files.get().basename,
+                         'Runkeeper-activity-data-2018.json.gz')
+        self.assertFalse(SyncCheckpoint.objects.exists())
+
+    @mock.patch('datauploader.tasks.uploads.replace_file')
+    def test_failed_uploads(self, replace_file):
+        def upload(filepath, *args, **kwargs):
+            if filepath.endswith('2017.json'):
+                time.sleep(0.1)
+                return
+            raise ValueError(os.path.basename(filepath))
+        replace_file.side_effect = upload
+        self.plan_years([2016, 2017, 2018])
+        with self.settings(OH_UPLOAD_WORKERS=3):
+            with self.assertRaisesMessage(
+                    ValueError, 'Runkeeper-activity-data-2016.json'):
+                tasks.upload_runkeeper_years('23456789', 'attempt')
+        # The upload that was still running finished and was recorded.
+        self.assertEqual(
+            list(self.runkeeper_member.data_files.values_list(
+                'year', flat=True)), [2017])
+        checkpoint = SyncCheckpoint.objects.get()
+        self.assertEqual(checkpoint.get_uploaded_years(), {2017})
+        self.runkeeper_member.refresh_from_db()
+        self.assertIsNone(self.runkeeper_member.sync_watermark)
+
+
+class FetchedActivitiesTestCase(IsolatedRunkeeperMixin, TestCase):
+    """
+    test that fetched activities reach the upload step without the cache
+    """
+
+    def setUp(self):
+        super().setUp()
+        oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="new_oh_access_token",
+                            refresh_token="new_oh_refresh_token",
+                            expires_in=36000)
+        oh_member.save()
+        self.runkeeper_member = DataSourceMember.objects.create(
+            user=oh_member, runkeeper_id=12345678)
+        self.items = [{'uri': '/fitnessActivities/{}'.format(n)}
+                      for n in range(3)]
+        plan = {'years': [{'year': 2018, 'complete': True,
+                           'background_items': [],
+                           'fitness_items': self.items}],
+                'new_watermark': None, 'full_sync': False}
+        SyncCheckpoint.objects.create(member=self.runkeeper_member,
+                                      plan=json.dumps(plan),
+                                      attempt='attempt')
+
+    @staticmethod
+    def activity(path, token, **kwargs):
+        return {'type': 'Running', 'start_time': path, 'path': []}
+
+    @mock.patch('datauploader.tasks.uploads.replace_file')
+    @mock.patch('datauploader.tasks.runkeeper_query')
+    def test_upload_reads_stored_activities(self, runkeeper_query,
+                                            replace_file):
+        runkeeper_query.side_effect = self.activity
+        self.assertEqual(tasks.fetch_runkeeper_activities(
+            '23456789', 'attempt', self.items[:2]), 2)
+        checkpoint = SyncCheckpoint.objects.get()
+        self.assertEqual(checkpoint.get_fetched_uris(),
+                         {'/fitnessActivities/0', '/fitnessActivities/1'})
+        # As if evicted from the cache by other syncs before the upload.
+        tasks.activity_cache.clear()
+        runkeeper_query.reset_mock()
+
+        written = []
+
+        def upload(filepath, *args, **kwargs):
+            with open(filepath) as f:
+                written.append(json.load(f))
+        replace_file.side_effect = upload
+        with self.settings(RUNKEEPER_FETCH_CHUNK_SIZE=2):
+            tasks.upload_runkeeper_years('23456789', 'attempt')
+        # Only the activity that wasn't stored was fetched.
+        self.assertEqual([c[0][0] for c in runkeeper_query.call_args_list],
+                         ['/fitnessActivities/2'])
+        self.assertEqual(
+            [a['start_time'] for a in written[0]['fitness_activities']],
+            [item['uri'] for item in self.items])
+        # Removed with the checkpoint once the sync is finished.
+        self.assertFalse(SyncCheckpoint.objects.exists())
+        self.assertFalse(FetchedActivity.objects.exists())
@@ -0,0 +1,99 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+from django.test import SimpleTestCase
+from datauploader.paths import decode_path, encode_path
+from datauploader.writers import YearlyJSONWriter, open_writer
+
+
+class YearlyJSONWriterTestCase(SimpleTestCase):
+    """
+    test that yearly files are written like a single json.dump
+    """
+
+    outdata = {
+        'background_activities': [],
+        'fitness_activities': [
+            {'type': 'Running', 'source': 'RunKeeper\n',
+             'path': [{'latitude': 52.1, 'longitude': 4.3, 'type': 'gps'},
+                      {'latitude': 52.2, 'longitude': 4.4, 'type': 'end'}]},
+            {'type': 'Cycling', 'source': '', 'path': []},
+        ],
+    }
+
+    def write(self, writer):
+        for name in sorted(self.outdata):
+            writer.write_collection(name, iter(self.outdata[name]))
+
+    def test_output_matches_json_dump(self):
+        f = io.StringIO()
+        writer = YearlyJSONWriter(f)
+        self.write(writer)
+        writer.close()
+        self.assertEqual(f.getvalue(),
+                         json.dumps(self.outdata, indent=2, sort_keys=True))
+
+    def test_compact_output_matches_json_dump(self):
+        f = io.StringIO()
+        writer = YearlyJSONWriter(f, indent=None)
+        self.write(writer)
+        writer.close()
+        self.assertEqual(f.getvalue(),
+                         json.dumps(self.outdata, sort_keys=True,
+                                    separators=(',', ':')))
+
+    def test_gzip_formats(self):
+        filepath = os.path.join(tempfile.mkdtemp(), 'data.gz')
+        with open_writer(filepath, 'json-gzip') as writer:
+            self.write(writer)
+        with gzip.open(filepath, 'rt') as f:
+            self.assertEqual(json.load(f), self.outdata)
+
+        with open_writer(filepath, 'ndjson-gzip') as writer:
+            self.write(writer)
+        with gzip.open(filepath, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line.pop('collection') for line in lines],
+                         ['fitness_activities'] * 2)
+        self.assertEqual(lines, self.outdata['fitness_activities'])
+
+    def test_collections_must_be_sorted(self):
+        writer = YearlyJSONWriter(io.StringIO())
+        writer.write_collection('fitness_activities', [])
+        with self.assertRaises(ValueError):
+            writer.write_collection('background_activities', [])
+
+
+class PathEncodingTestCase(SimpleTestCase):
+    """
+    test that encoded paths decode to the original points
+    """
+
+    keys = ['latitude', 'longitude', 'altitude', 'timestamp', 'type']
+    path = [
+        {'latitude': 52.0907006, 'longitude': 5.1214201, 'altitude': 4.5,
+         'timestamp': 0, 'type': 'start'},
+        {'latitude': 52.0907391, 'longitude': 5.121389, 'altitude': '',
+         'timestamp': 3.021, 'type': 'gps'},
+        {'latitude': 52.0906812, 'longitude': 5.1212735, 'altitude': 3.25,
+         'timestamp': 6.038, 'type': 'end'},
+    ]
+
+    def test_columns(self):
+        encoded = encode_path(self.path, 'columns', self.keys)
+        self.assertEqual(encoded['type'], ['start', 'gps', 'end'])
+        self.assertEqual(decode_path(encoded), self.path)
+
+    def test_columns_delta(self):
+        encoded = encode_path(self.path, 'columns-delta', self.keys)
+        self.assertEqual(encoded['latitude'], [520907006, 385, -579])
+        # Altitude has a missing value, so it isn't delta-encoded.
+        self.assertEqual(sorted(encoded['delta']),
+                         ['latitude', 'longitude', 'timestamp'])
+        self.assertEqual(decode_path(encoded), self.path)
+
+    def test_rows(self):
+        self.assertIs(encode_path(self.path, 'rows', self.keys), self.path)
+        self.assertIs(decode_path(self.path), self.path)
@@ -1,3 +1,6 @@
+import os
+import tempfile
+from datetime import timedelta
 from django.test import TestCase
 from freezegun import freeze_time
 from django.conf import settings
@@ -5,17 +8,24 @@ from django.core.management import call_command
 import vcr
 from open_humans.models import OpenHumansMember
 from main.models import DataSourceMember
+from main.helpers import get_runkeeper_file, invalidate_runkeeper_file
 import arrow
 from datauploader.celery import app
+from datauploader import tasks
 from main.management.commands import import_users
+from unittest import mock
+import requests
+from requests_respectful import RequestsRespectfulRateLimitedError
+from .helpers import IsolatedRunkeeperMixin
 
 
-class ManagementTestCase(TestCase):
+class ManagementTestCase(IsolatedRunkeeperMixin, TestCase):
     """
     test that files are parsed correctly
     """
 
     def setUp(self):
+        super().setUp()
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
         settings.RUNKEEPER_CLIENT_ID = 'RUNKEEPER_CLIENT_ID'
@@ -39,14 +49,115 @@ class ManagementTestCase(TestCase):
                          1)
         self.assertEqual(len(DataSourceMember.objects.filter(runkeeper_id=12345678)),
                          1)
+        # Each worker gets a connection to RunKeeper.
+        adapter = cmd.runkeeper_client.session.get_adapter(
+            'https://api.runkeeper.com')
+        self.assertEqual(adapter._pool_maxsize, 8)
 
+    @freeze_time('2016-06-24')
+    def test_import_command_skips_existing(self):
+        cmd = import_users.Command()
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none'):
+            cmd.handle(infile='main/tests/fixtures/import_list.txt',
+                       delimiter=",")
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        self.assertEqual(oh_member.access_token, 'new_oh_access_token')
+        self.assertEqual(oh_member.user.username, '23456789_openhumans')
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            cmd.handle(infile='main/tests/fixtures/import_list.txt',
+                       delimiter=",")
+            self.assertEqual(cassette.play_count, 0)
+        self.assertEqual(len(OpenHumansMember.objects.all()), 1)
+
+    def import_rows(self, rows, **options):
+        infile = tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                             delete=False)
+        self.addCleanup(os.remove, infile.name)
+        with infile:
+            infile.write(''.join(','.join(row) + '\n' for row in rows))
+        import_users.Command().handle(infile=infile.name, delimiter=',',
+                                      **options)
+
+    @freeze_time('2016-06-24')
+    @mock.patch('open_humans.models.OpenHumansMember.request_token_refresh',
+                return_value={'access_token': 'new_oh_access_token',
+                              'refresh_token': 'new_oh_refresh_token',
+                              'expires_in': 36000})
+    @mock.patch('main.management.commands.import_users.RunkeeperClient.'
+                'get_user', side_effect=lambda token: {'userID': token})
+    def test_import_staggers_first_syncs(self, get_user,
+                                         request_token_refresh):
+        self.import_rows([['1', 'refresh_1', '11'],
+                          ['2', 'refresh_2', '12'],
+                          ['3', 'refresh_3', '13']],
+                         batch_size=2, stagger=30)
+        # schedule_syncs starts the syncs when they're due.
+        now = arrow.get('2016-06-24').datetime
+        self.assertEqual(
+            list(DataSourceMember.objects.order_by('next_sync_at').values_list(
+                'runkeeper_id', 'next_sync_at')),
+            [('11', now), ('12', now + timedelta(seconds=30)),
+             ('13', now + timedelta(seconds=60))])
 
-class UpdateTestCase(TestCase):
+
+    @mock.patch('open_humans.models.OpenHumansMember.request_token_refresh',
+                side_effect=lambda token, **kwargs: {
+                    'access_token': 'new_oh_access_token',
+                    'refresh_token': 'new_' + token, 'expires_in': 36000})
+    @mock.patch('main.management.commands.import_users.RunkeeperClient.'
+                'get_user')
+    def test_import_refreshes_only_importable_members(self, get_user,
+                                                      request_token_refresh):
+        def lookup(token):
+            if token == 'broken':
+                raise requests.HTTPError('401 Client Error')
+            return {'userID': token}
+        get_user.side_effect = lookup
+        # A failed profile lookup, and a RunKeeper account listed twice.
+        self.import_rows([['1', 'refresh_1', 'broken'],
+                          ['2', 'refresh_2', '12'],
+                          ['3', 'refresh_3', '12']])
+        self.assertEqual([c[0][0] for c in request_token_refresh.call_args_list],
+                         ['refresh_2'])
+        self.assertEqual(
+            list(OpenHumansMember.objects.values_list('oh_id', flat=True)),
+            ['2'])
+        self.assertEqual(
+            list(DataSourceMember.objects.values_list('runkeeper_id',
+                                                      flat=True)), ['12'])
+
+    @mock.patch('open_humans.models.OpenHumansMember.request_token_refresh',
+                return_value={'access_token': 'new_oh_access_token',
+                              'refresh_token': 'new_oh_refresh_token',
+                              'expires_in': 36000})
+    @mock.patch('main.management.commands.import_users.RunkeeperClient.'
+                'get_user', side_effect=lambda token: {'userID': token})
+    @mock.patch('main.management.commands.import_users.'
+                'make_unique_usernames',
+                side_effect=lambda bases: {base: 'taken' for base in bases})
+    def test_import_failure_keeps_rest_of_batch(
+            self, make_unique_usernames, get_user, request_token_refresh):
+        # Both members are given the same username, so only one can be
+        # created.
+        with self.assertLogs('main.management.commands.import_users',
+                             'ERROR') as logs:
+            self.import_rows([['1', 'refresh_1', '11'],
+                              ['2', 'refresh_2', '12']])
+        self.assertIn('Import of 2 failed', logs.output[0])
+        self.assertEqual(
+            list(OpenHumansMember.objects.values_list('oh_id', flat=True)),
+            ['1'])
+
+
+class UpdateTestCase(IsolatedRunkeeperMixin, TestCase):
     """
     test that periodic updates pass
     """
 
     def setUp(self):
+        super().setUp()
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
         settings.RUNKEEPER_CLIENT_ID = 'RUNKEEPER_CLIENT_ID'
@@ -74,3 +185,139 @@ class UpdateTestCase(TestCase):
         call_command('update_data')
         runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
         self.assertEqual(runkeeper_member.last_updated, arrow.get('2016-06-24'))
+
+    @freeze_time('2016-06-24')
+    def test_update_command_skips_recent(self):
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            call_command('update_data', days=7)
+            self.assertEqual(cassette.play_count, 0)
+
+    @freeze_time('2016-06-24')
+    def test_update_command_dry_run(self):
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            call_command('update_data', dry_run=True)
+            self.assertEqual(cassette.play_count, 0)
+        runkeeper_member = DataSourceMember.objects.get(runkeeper_id=12345678)
+        self.assertEqual(runkeeper_member.last_updated,
+                         arrow.get('2016-06-19'))
+
+
+class SchedulingTestCase(TestCase):
+    """
+    test that members due for a sync are found in order
+    """
+
+    def setUp(self):
+        for oh_id, next_sync_at in [(1, '2016-06-20'), (2, '2016-06-30'),
+                                    (3, '2016-06-10')]:
+            oh_member = OpenHumansMember.create(
+                                oh_id=oh_id,
+                                access_token="new_oh_access_token",
+                                refresh_token="new_oh_refresh_token",
+                                expires_in=36000)
+            oh_member.save()
+            DataSourceMember.objects.create(
+                user=oh_member, runkeeper_id=oh_id,
+                next_sync_at=arrow.get(next_sync_at).datetime)
+
+    def test_due_for_sync(self):
+        due = DataSourceMember.objects.due_for_sync(
+            now=arrow.get('2016-06-24').datetime)
+        self.assertEqual([m.runkeeper_id for m in due], ['3', '1'])
+        due = DataSourceMember.objects.due_for_sync(
+            now=arrow.get('2016-06-24').datetime, limit=1)
+        self.assertEqual([m.runkeeper_id for m in due], ['3'])
+
+    @freeze_time('2016-06-24')
+    def test_schedule_next_sync(self):
+        member = DataSourceMember.objects.get(runkeeper_id=1)
+        member.schedule_next_sync()
+        self.assertEqual(member.next_sync_at, arrow.get('2016-06-28').datetime)
+
+    @freeze_time('2016-06-24')
+    @mock.patch('datauploader.tasks.process_runkeeper.apply_async')
+    def test_schedule_syncs(self, apply_async):
+        with self.settings(RUNKEEPER_SCHEDULE_PERIOD=600,
+                           RUNKEEPER_RATE_LIMIT=60,
+                           RUNKEEPER_SCHEDULE_SHARE=0.5,
+                           RUNKEEPER_SYNC_COST=300):
+            # Budget of 300 requests, or one sync.
+            self.assertEqual(tasks.schedule_syncs(), 1)
+            self.assertEqual(tasks.schedule_syncs(), 1)
+            self.assertEqual(tasks.schedule_syncs(), 0)
+        self.assertEqual([c[0][0] for c in apply_async.call_args_list],
+                         [('3',), ('1',)])
+        for c in apply_async.call_args_list:
+            self.assertTrue(0 <= c[1]['countdown'] < 600)
+        member = DataSourceMember.objects.get(runkeeper_id=3)
+        self.assertEqual(member.next_sync_at,
+                         arrow.get('2016-06-24 06:00').datetime)
+
+
+class FileListingTestCase(TestCase):
+    """
+    test that the dashboard's file listing is cached until files change
+    """
+
+    def setUp(self):
+        self.oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="new_oh_access_token",
+                            refresh_token="new_oh_refresh_token",
+                            expires_in=36000)
+        self.oh_member.save()
+
+    @mock.patch('main.helpers.api.exchange_oauth2_member', return_value={
+        'data': [{'basename': 'Runkeeper-activity-data-2018.json',
+                  'download_url': 'https://example.com/2018',
+                  'metadata': {'tags': ['GPS', 'Runkeeper']}}]})
+    def test_listing_cached(self, exchange_oauth2_member):
+        expected = {'Runkeeper-activity-data-2018.json':
+                    'https://example.com/2018'}
+        self.assertEqual(get_runkeeper_file(self.oh_member), expected)
+        self.assertEqual(get_runkeeper_file(self.oh_member), expected)
+        self.assertEqual(exchange_oauth2_member.call_count, 1)
+        invalidate_runkeeper_file(self.oh_member.oh_id)
+        self.assertEqual(get_runkeeper_file(self.oh_member), expected)
+        self.assertEqual(exchange_oauth2_member.call_count, 2)
+
+    @mock.patch('main.helpers.api.exchange_oauth2_member',
+                side_effect=Exception)
+    def test_errors_not_cached(self, exchange_oauth2_member):
+        self.assertEqual(get_runkeeper_file(self.oh_member), 'error')
+        self.assertEqual(get_runkeeper_file(self.oh_member), 'error')
+        self.assertEqual(exchange_oauth2_member.call_count, 2)
+
+
+class RunkeeperCompleteTestCase(TestCase):
+    """
+    test that connecting RunKeeper gives up while the realm is busy
+    """
+
+    def setUp(self):
+        settings.RUNKEEPER_CLIENT_ID = 'RUNKEEPER_CLIENT_ID'
+        settings.RUNKEEPER_CLIENT_SECRET = 'RUNKEEPER_CLIENT_SECRET'
+        self.oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="new_oh_access_token",
+                            refresh_token="new_oh_refresh_token",
+                            expires_in=36000)
+        self.oh_member.save()
+        self.client.force_login(self.oh_member.user)
+
+    @mock.patch('main.views.runkeeper_client.get_user',
+                side_effect=RequestsRespectfulRateLimitedError)
+    @mock.patch('main.views.requests.post')
+    def test_realm_busy(self, post, get_user):
+        post.return_value.json.return_value = {'access_token': 'rk_token'}
+        response = self.client.get('/runkeeper_complete/?code=abc',
+                                   follow=True)
+        self.assertEqual(response.redirect_chain[0][0], '/dashboard')
+        self.assertIn('Runkeeper is busy',
+                      str(list(response.context['messages'])[0]))
+        get_user.assert_called_once_with(
+            'rk_token', weight=settings.RUNKEEPER_INTERACTIVE_WEIGHT,
+            timeout=settings.RUNKEEPER_INTERACTIVE_TIMEOUT)
+        self.assertFalse(DataSourceMember.objects.exists())
@@ -6,9 +6,12 @@ from django.shortcuts import render, redirect
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 from .models import DataSourceMember
-from .helpers import get_runkeeper_file, check_update
+from .helpers import get_runkeeper_file, invalidate_runkeeper_file, \
+    check_update
+from datauploader.runkeeper import client as runkeeper_client
 from datauploader.tasks import process_runkeeper
 from ohapi import api
+from requests_respectful import RequestsRespectfulRateLimitedError
 import arrow
 
 # Set up logging.
@@ -103,6 +106,7 @@ def remove_runkeeper(request):
             api.delete_file(oh_member.access_token,
                             oh_member.oh_id,
                             file_basename="Runkeeper")
+            invalidate_runkeeper_file(oh_member.oh_id)
             messages.info(request, "Your Runkeeper account has been removed")
             runkeeper_account = request.user.oh_member.datasourcemember
             runkeeper_account.delete()
@@ -119,7 +123,7 @@ def remove_runkeeper(request):
 def update_data(request):
     if request.method == "POST" and request.user.is_authenticated:
         oh_member = request.user.oh_member
-        process_runkeeper.delay(oh_member.oh_id)
+        process_runkeeper.delay(oh_member.oh_id, interactive=True)
         runkeeper_member = oh_member.datasourcemember
         runkeeper_member.last_submitted = arrow.now().format()
         runkeeper_member.save()
@@ -140,11 +144,20 @@ def runkeeper_complete(request):
     # This creates an OpenHumansMember and associated user account.
     code = request.GET.get('code', '')
     ohmember = request.user.oh_member
-    runkeeper_member = runkeeper_code_to_member(code=code, ohmember=ohmember)
+    try:
+        runkeeper_member = runkeeper_code_to_member(code=code,
+                                                    ohmember=ohmember)
+    except RequestsRespectfulRateLimitedError:
+        logger.warning('Runkeeper realm busy, member {} not connected'.format(
+            ohmember.oh_id))
+        messages.info(request, ("Runkeeper is busy right now, please try "
+                                "connecting your Runkeeper account again in "
+                                "a few minutes"))
+        return redirect('/dashboard')
 
     if runkeeper_member:
         messages.info(request, "Your Runkeeper account has been connected")
-        process_runkeeper.delay(ohmember.oh_id)
+        process_runkeeper.delay(ohmember.oh_id, interactive=True)
         return redirect('/dashboard')
 
     logger.debug('Invalid code exchange. User returned to starting page.')
@@ -184,11 +197,11 @@ def runkeeper_code_to_member(code, ohmember):
                 runkeeper_member = DataSourceMember(
                     access_token=data['access_token'])
                 runkeeper_member.user = ohmember
-                prof = "https://api.runkeeper.com/user?access_token={}".format(
-                    data['access_token']
-                )
-                profile_response = requests.get(prof)
-                runkeeper_id = profile_response.json()['userID']
+                user_data = runkeeper_client.get_user(
+                    data['access_token'],
+                    weight=settings.RUNKEEPER_INTERACTIVE_WEIGHT,
+                    timeout=settings.RUNKEEPER_INTERACTIVE_TIMEOUT)
+                runkeeper_id = user_data['userID']
                 runkeeper_member.runkeeper_id = runkeeper_id
                 logger.debug('Member {} created.'.format(runkeeper_id))
                 print('make new Runkeeper member')
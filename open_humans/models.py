@@ -1,11 +1,17 @@
 from datetime import timedelta
+from functools import reduce
+import logging
+import operator
 
 import arrow
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 import requests
 
+logger = logging.getLogger(__name__)
+
 OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
@@ -19,18 +25,34 @@ def make_unique_username(base):
     """
     Ensure a unique username. Probably this never actually gets used.
     """
-    try:
-        User.objects.get(username=base)
-    except User.DoesNotExist:
-        return base
-    n = 2
-    while True:
-        name = base + str(n)
-        try:
-            User.objects.get(username=name)
+    return make_unique_usernames([base])[base]
+
+
+def make_unique_usernames(bases):
+    """
+    Return a dict with a unique username for each of bases.
+
+    A base that's taken gets the lowest free numeric suffix from 2 up, as
+    with make_unique_username. All names starting with one of the bases are
+    fetched in one query, however many of them there are.
+    """
+    bases = list(bases)
+    if not bases:
+        return {}
+    taken = set(User.objects.filter(reduce(operator.or_, (
+        Q(username__startswith=base) for base in bases))).values_list(
+            'username', flat=True))
+    usernames = {}
+    for base in bases:
+        name = base
+        n = 2
+        while name in taken:
+            name = base + str(n)
             n += 1
-        except User.DoesNotExist:
-            return name
+        # Names given out here are taken for the following bases.
+        taken.add(name)
+        usernames[base] = name
+    return usernames
 
 
 class OpenHumansMember(models.Model):
@@ -68,31 +90,103 @@ class OpenHumansMember(models.Model):
         return "<OpenHumansMember(oh_id='{}')>".format(
             self.oh_id)
 
+    @classmethod
+    def refresh_expiring_tokens(
+            cls, oh_ids, min_valid=3600,
+            client_id=settings.OPENHUMANS_CLIENT_ID,
+            client_secret=settings.OPENHUMANS_CLIENT_SECRET):
+        """
+        Refresh the tokens of members in oh_ids that expire within min_valid
+        seconds, e.g. ahead of syncing them, so that their tasks don't have
+        to. Returns the number of members whose token was refreshed; those
+        whose refresh failed or was refused are logged.
+        """
+        expiring = cls.objects.filter(
+            oh_id__in=oh_ids,
+            token_expires__lt=(arrow.now() + timedelta(
+                seconds=min_valid)).datetime)
+        refreshed = 0
+        failed = 0
+        for oh_member in expiring:
+            token_expires = oh_member.token_expires
+            try:
+                oh_member.get_access_token(client_id=client_id,
+                                           client_secret=client_secret,
+                                           min_valid=min_valid)
+            except requests.RequestException as e:
+                logger.warning('Token refresh failed for {}: {}'.format(
+                    oh_member.oh_id, e))
+                failed += 1
+                continue
+            # The expiry stays the same if Open Humans refused the refresh.
+            if oh_member.token_expires == token_expires:
+                logger.warning('Token refresh refused for {}'.format(
+                    oh_member.oh_id))
+                failed += 1
+                continue
+            refreshed += 1
+        if failed:
+            logger.warning('Token refresh failed for {} of {} members'.format(
+                failed, refreshed + failed))
+        return refreshed
+
     def get_access_token(self,
                          client_id=settings.OPENHUMANS_CLIENT_ID,
-                         client_secret=settings.OPENHUMANS_CLIENT_SECRET):
+                         client_secret=settings.OPENHUMANS_CLIENT_SECRET,
+                         min_valid=60):
         """
         Return access token. Refresh first if necessary.
+
+        Only one caller at a time refreshes a member's token: the others
+        wait for it and use the new token, instead of refreshing again with
+        a refresh token that was just used up.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens(client_id=client_id,
-                                 client_secret=client_secret)
+        # Also refresh if nearly expired (less than min_valid s remaining).
+        if not self._token_expires_within(min_valid):
+            return self.access_token
+        with transaction.atomic():
+            oh_member = type(self).objects.select_for_update().get(
+                pk=self.pk)
+            if oh_member._token_expires_within(min_valid):
+                oh_member._refresh_tokens(client_id=client_id,
+                                          client_secret=client_secret)
+        self.access_token = oh_member.access_token
+        self.refresh_token = oh_member.refresh_token
+        self.token_expires = oh_member.token_expires
         return self.access_token
 
-    def _refresh_tokens(self, client_id, client_secret):
+    def _token_expires_within(self, seconds):
+        return (arrow.get(self.token_expires) - timedelta(seconds=seconds) <
+                arrow.now())
+
+    @staticmethod
+    def request_token_refresh(refresh_token, client_id, client_secret):
         """
-        Refresh access token.
+        Exchange a refresh token for new tokens. Returns the token data, or
+        None if Open Humans refused.
+
+        The member's row is locked during the request (see
+        get_access_token), so it gives up after OH_TOKEN_REFRESH_TIMEOUT
+        seconds, raising requests.Timeout.
         """
         response = requests.post(
             'https://www.openhumans.org/oauth2/token/',
             data={
                 'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
-            auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
+                'refresh_token': refresh_token},
+            auth=requests.auth.HTTPBasicAuth(client_id, client_secret),
+            timeout=settings.OH_TOKEN_REFRESH_TIMEOUT)
         if response.status_code == 200:
-            data = response.json()
+            return response.json()
+        return None
+
+    def _refresh_tokens(self, client_id, client_secret):
+        """
+        Refresh access token.
+        """
+        data = self.request_token_refresh(self.refresh_token,
+                                          client_id, client_secret)
+        if data is not None:
             self.access_token = data['access_token']
             self.refresh_token = data['refresh_token']
             self.token_expires = self.get_expiration(data['expires_in'])
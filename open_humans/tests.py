@@ -1,3 +1,93 @@
+from unittest import mock
+from django.contrib.auth.models import User
 from django.test import TestCase
+from freezegun import freeze_time
+import requests
+import vcr
 
-# Create your tests here.
+from .models import (OpenHumansMember, make_unique_username,
+                     make_unique_usernames)
+
+
+@freeze_time('2016-06-24')
+class TokenRefreshTestCase(TestCase):
+    """
+    test that expired tokens are refreshed once
+    """
+
+    def setUp(self):
+        oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="old_oh_access_token",
+                            refresh_token="old_oh_refresh_token",
+                            expires_in=-3600)
+        oh_member.save()
+
+    def test_refresh_single_flight(self):
+        # Loaded before the refresh, like a concurrent task would have.
+        stale_member = OpenHumansMember.objects.get(oh_id=23456789)
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            self.assertEqual(oh_member.get_access_token(),
+                             'new_oh_access_token')
+            self.assertEqual(stale_member.get_access_token(),
+                             'new_oh_access_token')
+            self.assertEqual(cassette.play_count, 1)
+        self.assertEqual(stale_member.refresh_token, 'new_oh_refresh_token')
+
+    def test_refresh_expiring_tokens(self):
+        with vcr.use_cassette('main/tests/fixtures/import_users.yaml',
+                              record_mode='none') as cassette:
+            self.assertEqual(
+                OpenHumansMember.refresh_expiring_tokens(['23456789']), 1)
+            self.assertEqual(
+                OpenHumansMember.refresh_expiring_tokens(['23456789']), 0)
+            self.assertEqual(cassette.play_count, 1)
+
+    @mock.patch('open_humans.models.OpenHumansMember.request_token_refresh',
+                return_value=None)
+    def test_refresh_refused(self, request_token_refresh):
+        with self.assertLogs('open_humans.models', 'WARNING') as logs:
+            self.assertEqual(
+                OpenHumansMember.refresh_expiring_tokens(['23456789']), 0)
+        self.assertEqual(logs.output, [
+            'WARNING:open_humans.models:Token refresh refused for 23456789',
+            'WARNING:open_humans.models:Token refresh failed for 1 of 1 '
+            'members'])
+        self.assertEqual(request_token_refresh.call_count, 1)
+
+    @mock.patch('open_humans.models.requests.post',
+                side_effect=requests.Timeout('Read timed out.'))
+    def test_refresh_times_out(self, post):
+        with self.settings(OH_TOKEN_REFRESH_TIMEOUT=5), \
+                self.assertLogs('open_humans.models', 'WARNING'):
+            self.assertEqual(
+                OpenHumansMember.refresh_expiring_tokens(['23456789']), 0)
+        self.assertEqual(post.call_args[1]['timeout'], 5)
+
+
+class UsernameTestCase(TestCase):
+    """
+    test that unique usernames are found with one query
+    """
+
+    def setUp(self):
+        for username in ['1_openhumans', '1_openhumans2', '1_openhumans3',
+                         '2_openhumans5']:
+            User.objects.create(username=username)
+
+    def test_make_unique_username(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(make_unique_username('1_openhumans'),
+                             '1_openhumans4')
+        self.assertEqual(make_unique_username('2_openhumans'),
+                         '2_openhumans')
+
+    def test_make_unique_usernames(self):
+        with self.assertNumQueries(1):
+            usernames = make_unique_usernames(
+                ['1_openhumans', '1_openhumans4', '3_openhumans'])
+        self.assertEqual(usernames, {'1_openhumans': '1_openhumans4',
+                                     '1_openhumans4': '1_openhumans42',
+                                     '3_openhumans': '3_openhumans'})
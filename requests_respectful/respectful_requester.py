@@ -12,6 +12,213 @@ import requests
 import warnings
 
 
+# Sliding window rate limiting. Each realm has a sorted set of the requests
+# performed in it, scored by the time (in ms) they were performed. Entries
+# older than the realm's timespan are dropped, and a request is allowed if all
+# of its realms have fewer entries than their limit, in which case it's added
+# to all of them. Redis' clock is used so that all clients agree on the time.
+#
+# Clients waiting for a permit queue up in a second sorted set per realm,
+# and are only allowed once the free permits exceed the number of waiters
+# ahead of them. Requests that don't wait queue behind all waiters. A third
+# sorted set records when each waiter last checked in; waiters that haven't
+# for two timespans (e.g. because they crashed) are dropped from the queue.
+#
+# Waiters are ordered by weighted fair queuing: each waiter belongs to a flow
+# (e.g. the user it makes requests for) with a weight, and is scored with a
+# virtual finish time, 1 / weight after the later of the realm's virtual time
+# and the finish time of the previous waiter of its flow. The virtual time is
+# the score of the last waiter that was let through. A flow with many waiters
+# thus doesn't hold up flows with few, and flows get permits in proportion to
+# their weight while they're all waiting. Waiters without a flow each get a
+# flow of their own. Waiters with the same finish time are served in the order
+# of their ids, which acquire starts with the time they arrived. The virtual
+# time and the last finish time of each flow with waiters are kept in a hash
+# per realm.
+#
+# When the rate-limited service pushes back (see THROTTLE_SCRIPT), a hash per
+# realm holds a reduced limit and the time until which no requests are allowed
+# at all. Every permitted request raises the reduced limit by 1 / limit, i.e.
+# by about one per timespan, until it's back at the configured limit and the
+# hash is removed. Until then, each of them also keeps the hash for another
+# ten timespans, so the limit is only reset once requests stop.
+#
+# KEYS: the requests, waiters and heartbeats sorted sets and the adaptive and
+#       fairness hashes of each realm
+# ARGV: request id, waiter id ("" when not waiting), flow ("" for none),
+#       weight, then limit and timespan (in seconds) for each realm
+# Returns the time to wait (in ms) before trying again followed by the
+# (1-based) indexes of the realms that are rate-limited. Without the latter,
+# the request was allowed.
+PERMIT_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local request_id = ARGV[1]
+local waiter_id = ARGV[2]
+local flow = ARGV[3]
+local weight = tonumber(ARGV[4])
+
+local wait = 0
+local rate_limited = {}
+local adaptive_limits = {}
+for i = 1, #KEYS / 5 do
+    local requests_key = KEYS[i * 5 - 4]
+    local waiters_key = KEYS[i * 5 - 3]
+    local heartbeats_key = KEYS[i * 5 - 2]
+    local adaptive_key = KEYS[i * 5 - 1]
+    local fairness_key = KEYS[i * 5]
+    local limit = tonumber(ARGV[i * 2 + 3])
+    local timespan = tonumber(ARGV[i * 2 + 4]) * 1000
+
+    redis.call("ZREMRANGEBYSCORE", requests_key, "-inf", now - timespan)
+    local stale = redis.call("ZRANGEBYSCORE", heartbeats_key, "-inf", now - 2 * timespan)
+    for _, stale_id in ipairs(stale) do
+        redis.call("ZREM", waiters_key, stale_id)
+        redis.call("ZREM", heartbeats_key, stale_id)
+    end
+
+    local ahead
+    if waiter_id ~= "" then
+        if not redis.call("ZSCORE", waiters_key, waiter_id) then
+            local start = tonumber(redis.call("HGET", fairness_key, "vtime")) or 0
+            if flow ~= "" then
+                start = math.max(start, tonumber(redis.call("HGET", fairness_key, "flow:" .. flow)) or 0)
+            end
+            local finish = start + 1 / weight
+            if flow ~= "" then
+                redis.call("HSET", fairness_key, "flow:" .. flow, tostring(finish))
+            end
+            redis.call("ZADD", waiters_key, finish, waiter_id)
+        end
+        redis.call("ZADD", heartbeats_key, now, waiter_id)
+        redis.call("PEXPIRE", waiters_key, 2 * timespan)
+        redis.call("PEXPIRE", heartbeats_key, 2 * timespan)
+        redis.call("PEXPIRE", fairness_key, 2 * timespan)
+        ahead = redis.call("ZRANK", waiters_key, waiter_id)
+    else
+        ahead = redis.call("ZCARD", waiters_key)
+    end
+
+    local adaptive = redis.call("HMGET", adaptive_key, "limit", "blocked_until")
+    local blocked_until = tonumber(adaptive[2]) or 0
+    if adaptive[1] then
+        adaptive_limits[i] = tonumber(adaptive[1])
+        limit = math.min(limit, math.floor(adaptive_limits[i]))
+    end
+
+    local performed = redis.call("ZCARD", requests_key)
+    local free = limit - performed
+    if blocked_until > now then
+        table.insert(rate_limited, i)
+        wait = math.max(wait, blocked_until - now)
+    elseif free <= ahead then
+        table.insert(rate_limited, i)
+        -- Wait until enough requests have expired for this caller's turn.
+        local realm_wait = timespan
+        local index = ahead - free
+        if index < performed then
+            local expiring = redis.call("ZRANGE", requests_key, index, index, "WITHSCORES")
+            realm_wait = tonumber(expiring[2]) + timespan - now
+        end
+        wait = math.max(wait, realm_wait)
+    end
+end
+
+if #rate_limited == 0 then
+    for i = 1, #KEYS / 5 do
+        local limit = tonumber(ARGV[i * 2 + 3])
+        local timespan = tonumber(ARGV[i * 2 + 4]) * 1000
+        redis.call("ZADD", KEYS[i * 5 - 4], now, request_id)
+        redis.call("PEXPIRE", KEYS[i * 5 - 4], timespan)
+        if waiter_id ~= "" then
+            local finish = tonumber(redis.call("ZSCORE", KEYS[i * 5 - 3], waiter_id))
+            local vtime = tonumber(redis.call("HGET", KEYS[i * 5], "vtime")) or 0
+            if finish > vtime then
+                redis.call("HSET", KEYS[i * 5], "vtime", tostring(finish))
+            end
+            -- Forget the flow once its last waiter is through.
+            if flow ~= "" then
+                local flow_finish = tonumber(redis.call("HGET", KEYS[i * 5], "flow:" .. flow))
+                if flow_finish and flow_finish <= finish + 1e-9 then
+                    redis.call("HDEL", KEYS[i * 5], "flow:" .. flow)
+                end
+            end
+            redis.call("ZREM", KEYS[i * 5 - 3], waiter_id)
+            redis.call("ZREM", KEYS[i * 5 - 2], waiter_id)
+        end
+        local adaptive_limit = adaptive_limits[i]
+        if adaptive_limit then
+            adaptive_limit = adaptive_limit + 1 / adaptive_limit
+            if adaptive_limit >= limit then
+                redis.call("DEL", KEYS[i * 5 - 1])
+            else
+                redis.call("HSET", KEYS[i * 5 - 1], "limit", tostring(adaptive_limit))
+                redis.call("PEXPIRE", KEYS[i * 5 - 1], 10 * timespan)
+            end
+        end
+    end
+end
+
+table.insert(rate_limited, 1, math.max(wait, 1))
+return rate_limited
+"""
+
+# Back off after the rate-limited service pushed back (e.g. with HTTP 429):
+# halve the limit of each realm and allow no requests until retry_after has
+# passed, or for the time one request takes at the new limit. Pushback from
+# requests made before the realm started backing off is only used to extend
+# the pause, so that a burst of rejections halves the limit only once. The
+# state expires after ten timespans without requests (PERMIT_SCRIPT extends it
+# with every request it allows).
+#
+# KEYS: the adaptive hash of each realm
+# ARGV: retry after (in ms, "" if unknown), then limit and timespan (in
+#       seconds) for each realm
+THROTTLE_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local retry_after = tonumber(ARGV[1])
+
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[i * 2])
+    local timespan = tonumber(ARGV[i * 2 + 1]) * 1000
+    local adaptive = redis.call("HMGET", KEYS[i], "limit", "blocked_until")
+    local blocked_until = tonumber(adaptive[2]) or 0
+
+    if blocked_until <= now then
+        local adaptive_limit = math.max(1, math.floor((tonumber(adaptive[1]) or limit) / 2))
+        local backoff = retry_after or math.ceil(timespan / adaptive_limit)
+        redis.call("HSET", KEYS[i], "limit", tostring(adaptive_limit))
+        redis.call("HSET", KEYS[i], "blocked_until", tostring(now + backoff))
+    elseif retry_after and now + retry_after > blocked_until then
+        redis.call("HSET", KEYS[i], "blocked_until", tostring(now + retry_after))
+    end
+    redis.call("PEXPIRE", KEYS[i], 10 * timespan)
+end
+
+return 1
+"""
+
+# Realm configurations are cached in-process for this many seconds, so that
+# requests don't need to fetch them from Redis every time. Changes made through
+# this process are picked up immediately; changes made elsewhere after at most
+# this long.
+REALM_CACHE_TTL = 5
+
+# realm: (expiry time, (max_requests, timespan)), or (expiry time, None) for
+# realms that aren't registered
+_realm_cache = dict()
+
+# Code objects of the request functions that passed validation
+_validated_request_funcs = set()
+
+
 class RespectfulRequester:
 
     def __init__(self):
@@ -22,6 +229,9 @@ class RespectfulRequester:
         except ConnectionError:
             raise RequestsRespectfulRedisError("Could not establish a connection to the provided Redis server")
 
+        self._permit_script = self.redis.register_script(PERMIT_SCRIPT)
+        self._throttle_script = self.redis.register_script(THROTTLE_SCRIPT)
+
     def __getattr__(self, attr):
         if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
             return getattr(self, "_requests_proxy_%s" % attr)
@@ -37,23 +247,69 @@ class RespectfulRequester:
             warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
             realms = [realm]
 
-        registered_realms = self.fetch_registered_realms()
-
-        for r in realms:
-            if r not in registered_realms:
-                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+        self._validate_realms(realms)
 
         if wait:
-            while True:
-                try:
-                    return self._perform_request(request_func, realms=realms)
-                except RequestsRespectfulRateLimitedError:
-                    pass
+            self._validate_request_func(request_func)
+            self.acquire(realms)
 
-                time.sleep(1)
+            return request_func()
         else:
             return self._perform_request(request_func, realms=realms)
 
+    def acquire(self, realms, timeout=None, flow=None, weight=1):
+        """
+        Block until a request can be performed in all realms, and record it.
+
+        Sleeps until the next permit is expected to free up rather than polling.
+        Waiting callers are served by weighted fair queuing over their flows
+        (e.g. one per user), so that each flow gets a share of the permits in
+        proportion to its weight; callers without a flow are served in the order
+        they arrived. Raises RequestsRespectfulRateLimitedError if that takes
+        more than timeout seconds.
+        """
+        self._validate_realms(realms)
+
+        waiter_id = self._new_waiter_id()
+        deadline = None if timeout is None else time.time() + timeout
+
+        try:
+            while True:
+                rate_limited_realms, wait = self._acquire_permit(realms, waiter_id=waiter_id, flow=flow, weight=weight)
+
+                if not len(rate_limited_realms):
+                    return True
+
+                if deadline is not None and time.time() + wait > deadline:
+                    raise RequestsRespectfulRateLimitedError("Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms))
+
+                time.sleep(wait)
+        except BaseException:
+            self._leave_queue(realms, waiter_id)
+            raise
+
+    def throttled(self, realms, retry_after=None):
+        """
+        Report that the service behind realms rejected a request for exceeding
+        its rate limit, optionally asking to retry after retry_after seconds.
+
+        All clients then back off: requests are paused, and the limit of each
+        realm is halved and only gradually raised again as requests succeed.
+        """
+        self._validate_realms(realms)
+
+        keys = list()
+        args = ["" if retry_after is None else int(retry_after * 1000)]
+
+        for realm in realms:
+            max_requests, timespan = self._realm_config(realm)
+            keys.append(self._realm_adaptive_redis_key(realm))
+            args += [max_requests - config["safety_threshold"], timespan]
+
+        self._throttle_script(keys=keys, args=args)
+
+        return True
+
     def fetch_registered_realms(self):
         return list(map(lambda k: k.decode("utf-8"), self.redis.smembers("%s:REALMS" % self.redis_prefix)))
 
@@ -64,6 +320,8 @@ class RespectfulRequester:
             self.redis.hmset(redis_key, {"max_requests": max_requests, "timespan": timespan})
             self.redis.sadd("%s:REALMS" % self.redis_prefix, realm)
 
+        _realm_cache.pop(realm, None)
+
         return True
 
     def register_realms(self, realm_tuples):
@@ -80,14 +338,22 @@ class RespectfulRequester:
             if updatable_key in kwargs and type(kwargs[updatable_key]) == int:
                 self.redis.hset(redis_key, updatable_key, kwargs[updatable_key])
 
+        _realm_cache.pop(realm, None)
+
         return True
 
     def unregister_realm(self, realm):
         self.redis.delete(self._realm_redis_key(realm))
         self.redis.srem("%s:REALMS" % self.redis_prefix, realm)
+        self.redis.delete(
+            self._realm_requests_redis_key(realm),
+            self._realm_waiters_redis_key(realm),
+            self._realm_heartbeats_redis_key(realm),
+            self._realm_adaptive_redis_key(realm),
+            self._realm_fairness_redis_key(realm)
+        )
 
-        request_keys = self.redis.keys("%s:REQUEST:%s:*" % (self.redis_prefix, realm))
-        [self.redis.delete(k) for k in request_keys]
+        _realm_cache.pop(realm, None)
 
         return True
 
@@ -98,12 +364,10 @@ class RespectfulRequester:
         return True
 
     def realm_max_requests(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["max_requests".encode("utf-8")].decode("utf-8"))
+        return self._realm_config(realm)[0]
 
     def realm_timespan(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["timespan".encode("utf-8")].decode("utf-8"))
+        return self._realm_config(realm)[1]
 
     @classmethod
     def configure(cls, **kwargs):
@@ -158,44 +422,105 @@ class RespectfulRequester:
     def _perform_request(self, request_func, realms=None):
         self._validate_request_func(request_func)
 
-        rate_limited_realms = list()
-
-        for realm in realms:
-            if not self._can_perform_request(realm):
-                rate_limited_realms.append(realm)
+        rate_limited_realms, _ = self._acquire_permit(realms)
 
         if not len(rate_limited_realms):
-            for realm in realms:
-                request_uuid = str(uuid.uuid4())
-
-                self.redis.setex(
-                    name="%s:REQUEST:%s:%s" % (self.redis_prefix, realm, request_uuid),
-                    time=self.realm_timespan(realm),
-                    value=request_uuid
-                )
-
             return request_func()
         else:
             raise RequestsRespectfulRateLimitedError("Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms))
 
+    def _acquire_permit(self, realms, waiter_id=None, flow=None, weight=1):
+        """
+        Atomically record a request in all realms if none of them is rate-limited,
+        queueing up as waiter_id of flow if given. Returns the realms that are
+        rate-limited and the time (in seconds) to wait before trying again.
+        """
+        keys = list()
+        args = [str(uuid.uuid4()), waiter_id or "", flow or "", weight]
+
+        for realm in realms:
+            keys += [
+                self._realm_requests_redis_key(realm),
+                self._realm_waiters_redis_key(realm),
+                self._realm_heartbeats_redis_key(realm),
+                self._realm_adaptive_redis_key(realm),
+                self._realm_fairness_redis_key(realm)
+            ]
+            max_requests, timespan = self._realm_config(realm)
+            args += [max_requests - config["safety_threshold"], timespan]
+
+        result = self._permit_script(keys=keys, args=args)
+
+        return [realms[int(i) - 1] for i in result[1:]], int(result[0]) / 1000.0
+
+    @staticmethod
+    def _new_waiter_id():
+        # Ids sort by arrival, so that waiters tied in the queue keep it.
+        return "%020.6f:%s" % (time.time(), uuid.uuid4())
+
+    def _leave_queue(self, realms, waiter_id):
+        pipeline = self.redis.pipeline()
+
+        for realm in realms:
+            pipeline.zrem(self._realm_waiters_redis_key(realm), waiter_id)
+            pipeline.zrem(self._realm_heartbeats_redis_key(realm), waiter_id)
+
+        pipeline.execute()
+
     def _realm_redis_key(self, realm):
         return "%s:REALMS:%s" % (self.redis_prefix, realm)
 
+    def _realm_requests_redis_key(self, realm):
+        return "%s:REQUESTS:%s" % (self.redis_prefix, realm)
+
+    def _realm_waiters_redis_key(self, realm):
+        return "%s:WAITERS:%s" % (self.redis_prefix, realm)
+
+    def _realm_heartbeats_redis_key(self, realm):
+        return "%s:HEARTBEATS:%s" % (self.redis_prefix, realm)
+
+    def _realm_adaptive_redis_key(self, realm):
+        return "%s:ADAPTIVE:%s" % (self.redis_prefix, realm)
+
+    def _realm_fairness_redis_key(self, realm):
+        return "%s:FAIRNESS:%s" % (self.redis_prefix, realm)
+
     def _fetch_realm_info(self, realm):
         redis_key = self._realm_redis_key(realm)
         return self.redis.hgetall(redis_key)
 
+    def _realm_config(self, realm):
+        """
+        Return (max_requests, timespan) for a realm, or None if it isn't registered.
+        """
+        cached = _realm_cache.get(realm)
+
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        realm_info = self._fetch_realm_info(realm)
+
+        if "max_requests".encode("utf-8") in realm_info:
+            realm_config = (
+                int(realm_info["max_requests".encode("utf-8")].decode("utf-8")),
+                int(realm_info["timespan".encode("utf-8")].decode("utf-8"))
+            )
+        else:
+            realm_config = None
+
+        _realm_cache[realm] = (time.time() + REALM_CACHE_TTL, realm_config)
+
+        return realm_config
+
     def _requests_in_timespan(self, realm):
-        return len(
-            self.redis.scan(
-                cursor=0,
-                match="%s:REQUEST:%s:*" % (self.redis_prefix, realm),
-                count=self._redis_keys_in_db() + 100
-            )[1]
-        )
+        seconds, microseconds = self.redis.time()
+        now = seconds * 1000 + microseconds // 1000
 
-    def _redis_keys_in_db(self):
-        return self.redis.info().get("db%d" % config["redis"]["database"]).get("keys")
+        return self.redis.zcount(
+            self._realm_requests_redis_key(realm),
+            now - self.realm_timespan(realm) * 1000,
+            "+inf"
+        )
 
     def _can_perform_request(self, realm):
         return self._requests_in_timespan(realm) < (self.realm_max_requests(realm) - config["safety_threshold"])
@@ -237,14 +562,25 @@ class RespectfulRequester:
     def _requests_proxy_put(self, *args, **kwargs):
         return self._requests_proxy("put", *args, **kwargs)
 
+    def _validate_realms(self, realms):
+        for realm in realms:
+            if self._realm_config(realm) is None:
+                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+
     @staticmethod
     def _validate_request_func(request_func):
+        # The source of a call site doesn't change, so it's only inspected once.
+        if request_func.__code__ in _validated_request_funcs:
+            return
+
         request_func_string = inspect.getsource(request_func)
         post_lambda_string = request_func_string.split(":")[1].strip()
 
         if not post_lambda_string.startswith(config["requests_module_name"]) and not post_lambda_string.startswith("getattr(requests"):
             raise RequestsRespectfulError("The request lambda can only contain a requests function call")
 
+        _validated_request_funcs.add(request_func.__code__)
+
     @staticmethod
     def _config():
         return config